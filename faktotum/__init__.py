@@ -1,8 +1,42 @@
+import importlib
 import logging
-import transformers
-from faktotum import typing, utils
-from faktotum.kb import KnowledgeBase
-from faktotum.pipelines import ned, nel, ner
 
 logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
 logging.getLogger("transformers").setLevel(logging.ERROR)
+
+# attributes are imported on first access, so `import faktotum` stays fast
+# and heavy dependencies like torch and transformers are only loaded when
+# a pipeline is used
+_LAZY_ATTRIBUTES = {
+    "typing": "faktotum.typing",
+    "utils": "faktotum.utils",
+    "KnowledgeBase": "faktotum.kb",
+    "aned": "faktotum.aio",
+    "aner": "faktotum.aio",
+    "anel": "faktotum.aio",
+    "ned": "faktotum.pipelines",
+    "ned_batch": "faktotum.pipelines",
+    "nel": "faktotum.pipelines",
+    "nel_stream": "faktotum.pipelines",
+    "ner": "faktotum.pipelines",
+    "ner_batch": "faktotum.pipelines",
+    "ner_stream": "faktotum.pipelines",
+    "preload": "faktotum.pipelines",
+    "profile": "faktotum.profiling",
+    "trace": "faktotum.tracing",
+}
+
+__all__ = list(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(_LAZY_ATTRIBUTES[name])
+    value = module if module.__name__ == f"{__name__}.{name}" else getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,393 @@
+"""
+faktotum.aio
+~~~~~~~~~~~~
+
+This module implements coroutines for the pipelines, batching sentences of
+concurrent callers into shared forward passes.
+"""
+
+import asyncio
+import logging
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Hashable, List, Optional, Tuple, Union
+
+from faktotum.kb import KnowledgeBase
+from faktotum.pipelines import ned_batch, ner_batch, segment
+from faktotum.typing import TaggedTokens
+
+# threads segmenting texts, inference runs on a single separate thread
+MAX_WORKERS = 4
+# maximum number of documents per batch, and seconds to wait for them
+MAX_BATCH_SIZE = 32
+MAX_WAIT = 0.005
+
+_EXECUTORS = dict()
+_BATCHERS = weakref.WeakKeyDictionary()
+
+
+class MicroBatcher:
+    """Collect concurrent requests into batches for one batch function.
+
+    A batch is started as soon as `max_batch_size` requests are waiting, or
+    `max_wait` seconds after its first request arrived. Requests with the
+    same key that are still in flight share one result, and requests
+    cancelled before their batch started are dropped. The batch function
+    may return an exception in place of a result, to fail only that
+    request.
+
+    Parameters
+    ----------
+    function : callable
+        Function mapping a list of payloads to a list of results.
+    executor : ThreadPoolExecutor
+        Executor the batch function runs on.
+    max_batch_size : int
+        Maximum number of requests per batch.
+    max_wait : float
+        Maximum number of seconds a request waits for others.
+    """
+
+    def __init__(
+        self,
+        function: Callable[[List[Any]], List[Any]],
+        executor: ThreadPoolExecutor,
+        max_batch_size: int = 32,
+        max_wait: float = 0.01,
+    ):
+        self.function = function
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.pending = dict()
+
+    async def submit(self, payload: Any, key: Optional[Hashable] = None) -> Any:
+        """Wait for the result of a payload.
+
+        Parameters
+        ----------
+        payload : any
+            The input of the batch function.
+        key : hashable, optional
+            If set, requests with equal keys are assumed to have equal
+            results and share one computation.
+
+        Returns
+        -------
+        any
+            The result for the payload.
+        """
+        future = self.pending.get(key) if key is not None else None
+        if future is None:
+            future = asyncio.get_event_loop().create_future()
+            if key is None:
+                await self.queue.put((payload, future))
+                return await future
+            future.add_done_callback(lambda _: self.pending.pop(key, None))
+            self.pending[key] = future
+            await self.queue.put((payload, future))
+        # a cancelled caller must not cancel the result for the others
+        return await asyncio.shield(future)
+
+    async def _collect(self) -> List[Tuple[Any, asyncio.Future]]:
+        loop = asyncio.get_event_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        """Process batches until cancelled."""
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [
+                (payload, future)
+                for payload, future in await self._collect()
+                if not future.done()
+            ]
+            if not batch:
+                continue
+            payloads = [payload for payload, _ in batch]
+            logging.info(f"Processing a batch of {len(payloads)} requests...")
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.function, payloads
+                )
+            except Exception as error:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+            else:
+                for (_, future), result in zip(batch, results):
+                    if future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+
+
+def get_executor(name: str) -> ThreadPoolExecutor:
+    """Return the shared executor for `segmentation` or `inference`.
+
+    The models and knowledge bases are not thread-safe, so all inference
+    runs one batch after another on one thread.
+    """
+    if name not in _EXECUTORS:
+        workers = MAX_WORKERS if name == "segmentation" else 1
+        _EXECUTORS[name] = ThreadPoolExecutor(workers, thread_name_prefix=name)
+    return _EXECUTORS[name]
+
+
+def _isolate_errors(
+    function: Callable[[List[Any]], List[Any]],
+) -> Callable[[List[Any]], List[Any]]:
+    # if a batch fails, its payloads are retried one by one, so a bad
+    # request only fails itself and not the others in its batch
+    def batch(payloads: List[Any]) -> List[Any]:
+        try:
+            return function(payloads)
+        except Exception:
+            if len(payloads) == 1:
+                raise
+        results = list()
+        for payload in payloads:
+            try:
+                results.extend(function([payload]))
+            except Exception as error:
+                results.append(error)
+        return results
+
+    return batch
+
+
+def _check_text(text: Any) -> Union[str, List[List[str]]]:
+    if not isinstance(text, str) and not (
+        isinstance(text, list)
+        and all(
+            isinstance(sentence, list)
+            and all(isinstance(word, str) for word in sentence)
+            for sentence in text
+        )
+    ):
+        raise ValueError(
+            "The field 'text' must be a string or a list of tokenized sentences."
+        )
+    return text
+
+
+def _discard_batcher(loop: weakref.ref, batchers: dict, key: Hashable):
+    batcher = batchers.pop(key, None)
+    loop = loop()
+    if batcher is not None and loop is not None and not loop.is_closed():
+        loop.call_soon_threadsafe(batcher.task.cancel)
+
+
+def _get_batcher(
+    key: Hashable,
+    function: Callable[[List[Any]], List[Any]],
+    kb: Optional[KnowledgeBase] = None,
+) -> MicroBatcher:
+    loop = asyncio.get_event_loop()
+    batchers = _BATCHERS.setdefault(loop, dict())
+    if key not in batchers:
+        batcher = MicroBatcher(
+            _isolate_errors(function),
+            get_executor("inference"),
+            MAX_BATCH_SIZE,
+            MAX_WAIT,
+        )
+        # the event loop only keeps weak references to its tasks
+        batcher.task = asyncio.ensure_future(batcher.run())
+        batchers[key] = batcher
+        if kb is not None:
+            # batchers reference their knowledge base weakly, and are
+            # stopped once it is garbage collected
+            weakref.finalize(kb, _discard_batcher, weakref.ref(loop), batchers, key)
+    return batchers[key]
+
+
+async def _aner(
+    text: Union[str, List[List[str]]],
+    domain: str,
+    batch_size: int,
+    precision: str,
+    backend: str,
+) -> TaggedTokens:
+    _check_text(text)
+    if isinstance(text, str):
+        loop = asyncio.get_event_loop()
+        text = await loop.run_in_executor(get_executor("segmentation"), segment, text)
+    batcher = _get_batcher(
+        ("ner", domain, batch_size, precision, backend),
+        lambda documents: ner_batch(documents, domain, batch_size, precision, backend),
+    )
+    return await batcher.submit(text)
+
+
+async def _aned(
+    tokens: TaggedTokens,
+    kb: KnowledgeBase,
+    domain: str,
+    candidate_threshold: float,
+    precision: str,
+    backend: str,
+) -> TaggedTokens:
+    # a weak reference compares equal only while the knowledge base lives,
+    # so a batcher is never handed to another one at the same address
+    reference = weakref.ref(kb)
+    batcher = _get_batcher(
+        ("ned", reference, domain, candidate_threshold, precision, backend),
+        lambda frames: ned_batch(
+            frames, reference(), domain, candidate_threshold, precision, backend
+        ),
+        kb,
+    )
+    return await batcher.submit(tokens)
+
+
+async def _anel(
+    text: Union[str, List[List[str]]],
+    kb: KnowledgeBase,
+    domain: str,
+    candidate_threshold: float,
+    batch_size: int,
+    precision: str,
+    backend: str,
+) -> TaggedTokens:
+    tokens = await _aner(text, domain, batch_size, precision, backend)
+    return await _aned(tokens, kb, domain, candidate_threshold, precision, backend)
+
+
+async def aner(
+    text: Union[str, List[List[str]]],
+    domain: str,
+    batch_size: int = 16,
+    precision: str = "fp32",
+    backend: str = "torch",
+    timeout: Optional[float] = None,
+) -> TaggedTokens:
+    """Named Entity Recognition without blocking the event loop.
+
+    The text is segmented on a thread pool, and its sentences share forward
+    passes with the texts of other callers awaiting at the same time.
+
+    Parameters
+    ----------
+    text : str or list
+        The text to process, or its tokenized sentences as lists of words.
+    domain : str
+        Domain of the text, either `literary-texts` or `press-texts`.
+    batch_size : int
+        Number of sentences per forward pass.
+    precision : str
+        Numeric precision of the models, either `fp32` or `int8`.
+    backend : str
+        Either `torch` or `onnx`.
+    timeout : float, optional
+        Maximum number of seconds to wait for the result. A text whose
+        batch has not started yet when the call is cancelled or times out
+        is not processed.
+
+    Returns
+    -------
+    TaggedTokens
+        The tagged tokens.
+    """
+    return await asyncio.wait_for(
+        _aner(text, domain, batch_size, precision, backend), timeout
+    )
+
+
+async def aned(
+    tokens: TaggedTokens,
+    kb: KnowledgeBase,
+    domain: str,
+    candidate_threshold: float = 0.94,
+    precision: str = "fp32",
+    backend: str = "torch",
+    timeout: Optional[float] = None,
+) -> TaggedTokens:
+    """Named Entity Disambiguation without blocking the event loop.
+
+    Parameters
+    ----------
+    tokens : TaggedTokens
+        The tagged tokens.
+    kb : KnowledgeBase
+        The knowledge base to link entities.
+    domain : str
+        Domain of the text, either `literary-texts` or `press-texts`.
+    candidate_threshold : float
+        Minimum Jaro-Winkler similarity of a candidate surface form.
+    precision : str
+        Numeric precision of the models, either `fp32` or `int8`.
+    backend : str
+        Either `torch` or `onnx`.
+    timeout : float, optional
+        Maximum number of seconds to wait for the result.
+
+    Returns
+    -------
+    TaggedTokens
+        The tagged tokens, with the linked entity identifiers (or `NIL`)
+        in the column `entity_id`.
+    """
+    return await asyncio.wait_for(
+        _aned(tokens, kb, domain, candidate_threshold, precision, backend), timeout
+    )
+
+
+async def anel(
+    text: Union[str, List[List[str]]],
+    kb: KnowledgeBase,
+    domain: str,
+    candidate_threshold: float = 0.94,
+    batch_size: int = 16,
+    precision: str = "fp32",
+    backend: str = "torch",
+    timeout: Optional[float] = None,
+) -> TaggedTokens:
+    """Named Entity Linking without blocking the event loop.
+
+    Recognition and disambiguation of concurrently awaited texts are
+    batched, see `aner`. Candidate search runs together with the
+    disambiguation model on the inference thread.
+
+    Parameters
+    ----------
+    text : str or list
+        The text to process, or its tokenized sentences as lists of words.
+    kb : KnowledgeBase
+        The knowledge base to link entities.
+    domain : str
+        Domain of the text, either `literary-texts` or `press-texts`.
+    candidate_threshold : float
+        Minimum Jaro-Winkler similarity of a candidate surface form.
+    batch_size : int
+        Number of sentences per forward pass of the recognition model.
+    precision : str
+        Numeric precision of the models, either `fp32` or `int8`.
+    backend : str
+        Either `torch` or `onnx`.
+    timeout : float, optional
+        Maximum number of seconds to wait for the result, for recognition
+        and disambiguation together.
+
+    Returns
+    -------
+    TaggedTokens
+        The tagged tokens.
+    """
+    return await asyncio.wait_for(
+        _anel(text, kb, domain, candidate_threshold, batch_size, precision, backend),
+        timeout,
+    )
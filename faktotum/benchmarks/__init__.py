@@ -0,0 +1,24 @@
+"""
+faktotum.benchmarks
+~~~~~~~~~~~~~~~~~~~
+
+This package implements benchmarks on synthetic texts and knowledge bases.
+Run them with `python -m faktotum.benchmarks`.
+"""
+
+from faktotum.benchmarks.suite import (
+    BENCHMARKS,
+    SIZES,
+    compare,
+    load,
+    report,
+    run,
+    save,
+)
+from faktotum.benchmarks.synthetic import (
+    create_checkpoints,
+    generate_knowledge_base,
+    generate_sentences,
+    generate_text,
+    write_knowledge_base,
+)
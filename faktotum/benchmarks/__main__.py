@@ -0,0 +1,95 @@
+"""
+faktotum.benchmarks.__main__
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+This module implements the command line interface of the benchmarks.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+from faktotum.benchmarks.suite import (
+    BENCHMARKS,
+    SIZES,
+    compare,
+    load,
+    report,
+    run,
+    save,
+)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m faktotum.benchmarks",
+        description="Benchmark the pipelines on synthetic data.",
+    )
+    parser.add_argument(
+        "--benchmarks",
+        nargs="+",
+        default=list(BENCHMARKS),
+        choices=BENCHMARKS,
+        help="Benchmarks to run.",
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=list(SIZES),
+        help="Number of contexts of the knowledge bases.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=10, help="Timed calls per benchmark."
+    )
+    parser.add_argument(
+        "--sentences", type=int, default=100, help="Sentences per text."
+    )
+    parser.add_argument(
+        "--directory",
+        type=Path,
+        help="Directory for generated knowledge bases and checkpoints.",
+    )
+    parser.add_argument("--ner-model", help="NER checkpoint, instead of a random one.")
+    parser.add_argument("--ned-model", help="NED checkpoint, instead of a random one.")
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=Path("benchmark.json"),
+        help="File the results are written to.",
+    )
+    parser.add_argument("--baseline", type=Path, help="Results to compare with.")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative slowdown of the median latency that counts as regression.",
+    )
+    args = parser.parse_args(argv)
+
+    checkpoints = None
+    if args.ner_model or args.ned_model:
+        if not (args.ner_model and args.ned_model):
+            parser.error("--ner-model and --ned-model must be given together.")
+        checkpoints = {"ner": args.ner_model, "ned": args.ned_model}
+    results = run(
+        args.benchmarks,
+        args.sizes,
+        args.repeat,
+        args.sentences,
+        args.directory,
+        checkpoints,
+    )
+    save(results, args.output)
+    comparisons = None
+    if args.baseline:
+        comparisons = compare(results, load(args.baseline), args.tolerance)
+    print(report(results, comparisons))
+    if comparisons and any(comparison["regression"] for comparison in comparisons):
+        print(f"Regressions of more than {args.tolerance:.0%} against the baseline.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
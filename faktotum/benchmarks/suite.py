@@ -0,0 +1,369 @@
+"""
+faktotum.benchmarks.suite
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+This module implements the benchmarks and the comparison with a baseline.
+"""
+
+import functools
+import itertools
+import json
+import logging
+import multiprocessing
+import platform
+import sys
+import time
+from pathlib import Path
+from queue import Empty
+from typing import Dict, Iterable, List, Optional, Union
+
+import numpy as np
+
+from faktotum.benchmarks.synthetic import (
+    create_checkpoints,
+    generate_sentences,
+    generate_text,
+    write_knowledge_base,
+)
+
+BENCHMARKS = ("ner", "ned", "nel", "get_best_candidate", "from_dump", "load_binary")
+# benchmarks that run once per knowledge base size
+KB_BENCHMARKS = ("ned", "nel", "get_best_candidate", "from_dump", "load_binary")
+# benchmarks that only load the knowledge base
+LOADING_BENCHMARKS = ("from_dump", "load_binary")
+SIZES = (1000, 10000, 100000, 1000000)
+DOMAIN = "press-texts"
+
+
+def _peak_rss_mb() -> float:
+    import resource
+
+    status = Path("/proc/self/status")
+    if status.exists():
+        # unlike ru_maxrss, not inherited from the parent process
+        for line in status.read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 ** (2 if sys.platform == "darwin" else 1)
+
+
+def _use_checkpoints(checkpoints: Dict[str, str]):
+    # must run before faktotum.pipelines is imported, which reads the names
+    from faktotum.models import MODEL_NAMES
+
+    for task, path in checkpoints.items():
+        for domain in MODEL_NAMES[task]:
+            MODEL_NAMES[task][domain] = path
+
+
+def _load_knowledge_base(filepath: Path, seed: int):
+    from faktotum.kb import KnowledgeBase
+    from faktotum.models import MODEL_NAMES
+    from faktotum.pipelines import load_pipeline
+
+    kb = KnowledgeBase.from_dump(filepath)
+    # random embeddings, so the benchmarks measure linking, not the lazy
+    # vectorization of the whole knowledge base
+    dimensions = load_pipeline("ned", DOMAIN).model.config.hidden_size
+    rng = np.random.RandomState(seed)
+    kb.add_embeddings(
+        np.arange(len(kb.vectorized)),
+        rng.standard_normal((len(kb.vectorized), dimensions)).astype(np.float32),
+    )
+    kb.model_name = MODEL_NAMES["ned"][DOMAIN]
+    return kb
+
+
+def _tagged_tokens(n_sentences: int, seed: int):
+    import pandas as pd
+
+    rows = list()
+    for sentence_id, (words, tags) in enumerate(generate_sentences(n_sentences, seed)):
+        rows.extend(zip([sentence_id] * len(words), words, tags))
+    return pd.DataFrame(rows, columns=["sentence_id", "word", "entity"])
+
+
+def _run_case(name: str, size: Optional[int], options: dict) -> dict:
+    logging.getLogger().setLevel(logging.WARNING)
+    _use_checkpoints(options["checkpoints"])
+    from faktotum.kb import KnowledgeBase
+
+    seed = options["seed"]
+    if name in KB_BENCHMARKS:
+        filepath = Path(options["directory"], f"kb-{size}-{seed}.json")
+    if name not in LOADING_BENCHMARKS:
+        # not imported for loading, to measure the memory of the KB alone
+        from faktotum import pipelines
+        from faktotum.utils import get_best_candidate
+
+        text = generate_text(options["sentences"], seed)
+        tokens = _tagged_tokens(options["sentences"], seed)
+    if name in ("ned", "nel", "get_best_candidate"):
+        kb = _load_knowledge_base(filepath, seed)
+
+    if name == "ner":
+        function = functools.partial(pipelines.ner, text, DOMAIN)
+        items, unit = len(tokens), "tokens"
+    elif name == "ned":
+
+        def function():
+            # ned adds a column, so every call gets fresh tokens
+            return pipelines.ned(tokens.copy(), kb, DOMAIN)
+
+        items, unit = len(tokens), "tokens"
+    elif name == "nel":
+        function = functools.partial(pipelines.nel, text, kb, DOMAIN)
+        items, unit = len(tokens), "tokens"
+    elif name == "get_best_candidate":
+        pipeline = pipelines.load_pipeline("ned", DOMAIN)
+        rng = np.random.RandomState(seed)
+        queries = itertools.cycle(
+            [
+                (
+                    " ".join(words[i : i + 2]),
+                    rng.standard_normal(pipeline.model.config.hidden_size),
+                )
+                for words, tags in generate_sentences(options["sentences"], seed)
+                for i, tag in enumerate(tags)
+                if tag == "B-PER"
+            ]
+        )
+
+        def function():
+            mention, embedding = next(queries)
+            return get_best_candidate(mention, embedding, kb, pipeline, 0.94)
+
+        items, unit = 1, "mentions"
+    elif name == "from_dump":
+        function = functools.partial(KnowledgeBase.from_dump, filepath)
+        items, unit = size, "contexts"
+    elif name == "load_binary":
+        function = functools.partial(
+            KnowledgeBase.load_binary, filepath.with_suffix(".bin")
+        )
+        items, unit = size, "contexts"
+    else:
+        raise ValueError(f"The benchmark {name} is not supported.")
+
+    # the first call loads models and builds lazy indices
+    if name not in LOADING_BENCHMARKS:
+        function()
+    timings = list()
+    for _ in range(options["repeat"]):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    timings = np.array(timings)
+    return {
+        "benchmark": name,
+        "size": size,
+        "repeat": len(timings),
+        "items": items,
+        "unit": unit,
+        "mean_seconds": float(timings.mean()),
+        "p50_seconds": float(np.percentile(timings, 50)),
+        "p99_seconds": float(np.percentile(timings, 99)),
+        "throughput": float(items * len(timings) / timings.sum()),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    }
+
+
+def _child(name: str, size: Optional[int], options: dict, queue):
+    try:
+        queue.put(_run_case(name, size, options))
+    except Exception as error:
+        queue.put({"benchmark": name, "size": size, "error": repr(error)})
+
+
+def run(
+    benchmarks: Iterable[str] = BENCHMARKS,
+    sizes: Iterable[int] = SIZES,
+    repeat: int = 10,
+    sentences: int = 100,
+    directory: Optional[Union[str, Path]] = None,
+    checkpoints: Optional[Dict[str, str]] = None,
+    seed: int = 23,
+) -> List[dict]:
+    """Run benchmarks on synthetic data.
+
+    Every benchmark runs in a fresh process, so the peak resident memory is
+    measured per benchmark. It includes loading the models and the
+    knowledge base. Texts have `sentences` sentences; the knowledge base
+    benchmarks run once per size, i.e. number of contexts.
+
+    Parameters
+    ----------
+    benchmarks : list
+        Names of the benchmarks, see `BENCHMARKS`.
+    sizes : list
+        Knowledge base sizes.
+    repeat : int
+        Number of timed calls per benchmark.
+    sentences : int
+        Number of sentences per text.
+    directory : str or Path, optional
+        Directory for the generated knowledge bases and checkpoints,
+        defaults to the faktotum cache.
+    checkpoints : dict, optional
+        Paths of the `ner` and `ned` models, defaults to small random
+        checkpoints created in `directory`.
+    seed : int
+        Seed of the synthetic data.
+
+    Returns
+    -------
+    list
+        One result per benchmark and size.
+    """
+    from faktotum.models import CACHE_DIR
+
+    directory = Path(directory) if directory else Path(CACHE_DIR, "benchmarks")
+    directory.mkdir(parents=True, exist_ok=True)
+    if checkpoints is None:
+        checkpoints = create_checkpoints(Path(directory, "checkpoints"), seed)
+    options = {
+        "checkpoints": checkpoints,
+        "directory": str(directory),
+        "repeat": repeat,
+        "sentences": sentences,
+        "seed": seed,
+    }
+    cases = list()
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            raise ValueError(f"The benchmark {name} is not supported.")
+        if name in KB_BENCHMARKS:
+            cases.extend((name, size) for size in sizes)
+        else:
+            cases.append((name, None))
+    binary = any(name == "load_binary" for name, _ in cases)
+    for size in sorted(set(size for _, size in cases if size is not None)):
+        filepath = Path(directory, f"kb-{size}-{seed}.json")
+        if not filepath.exists():
+            write_knowledge_base(filepath, size, seed=seed)
+        if binary and not Path(filepath.with_suffix(".bin"), "metadata.json").exists():
+            from faktotum.kb import KnowledgeBase
+
+            KnowledgeBase.from_dump(filepath).save_binary(filepath.with_suffix(".bin"))
+
+    context = multiprocessing.get_context("spawn")
+    results = list()
+    for name, size in cases:
+        logging.info(f"Running benchmark {name}" + (f" ({size})..." if size else "..."))
+        queue = context.Queue()
+        process = context.Process(target=_child, args=(name, size, options, queue))
+        process.start()
+        while True:
+            try:
+                result = queue.get(timeout=1)
+                break
+            except Empty:
+                # e.g. killed for running out of memory
+                if not process.is_alive():
+                    error = f"Process exited with code {process.exitcode}."
+                    result = {"benchmark": name, "size": size, "error": error}
+                    break
+        process.join()
+        if "error" in result:
+            logging.error(f"Benchmark {name} failed: {result['error']}")
+        results.append(result)
+    return results
+
+
+def save(results: List[dict], filepath: Union[str, Path]):
+    """Write results as JSON, together with the versions they were run on."""
+    import torch
+    import transformers
+
+    metadata = {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "numpy": np.__version__,
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+    }
+    Path(filepath).write_text(
+        json.dumps({"metadata": metadata, "results": results}, indent=2),
+        encoding="utf-8",
+    )
+
+
+def load(filepath: Union[str, Path]) -> List[dict]:
+    """Read results written by `save`."""
+    return json.loads(Path(filepath).read_text(encoding="utf-8"))["results"]
+
+
+def compare(
+    results: List[dict], baseline: List[dict], tolerance: float = 0.2
+) -> List[dict]:
+    """Compare the median latencies of results with a baseline.
+
+    Parameters
+    ----------
+    results : list
+        The current results.
+    baseline : list
+        The results to compare with.
+    tolerance : float
+        Relative slowdown of the median latency that counts as regression.
+
+    Returns
+    -------
+    list
+        For each result with a baseline, the benchmark, the size, the ratio
+        of the median latencies and whether it is a regression.
+    """
+    reference = {
+        (result["benchmark"], result["size"]): result
+        for result in baseline
+        if "error" not in result
+    }
+    comparisons = list()
+    for result in results:
+        base = reference.get((result["benchmark"], result["size"]))
+        if base is None or "error" in result:
+            continue
+        ratio = result["p50_seconds"] / base["p50_seconds"]
+        comparisons.append(
+            {
+                "benchmark": result["benchmark"],
+                "size": result["size"],
+                "ratio": round(ratio, 3),
+                "regression": ratio > 1 + tolerance,
+            }
+        )
+    return comparisons
+
+
+def report(results: List[dict], comparisons: Optional[List[dict]] = None) -> str:
+    """Format results, and their comparison with a baseline, as a table."""
+    ratios = {
+        (comparison["benchmark"], comparison["size"]): comparison
+        for comparison in comparisons or list()
+    }
+    lines = [
+        f"{'benchmark':<20}{'size':>9}{'p50 ms':>11}{'p99 ms':>11}"
+        f"{'throughput':>22}{'peak MB':>10}{'vs. baseline':>14}"
+    ]
+    for result in results:
+        size = result["size"] or "-"
+        if "error" in result:
+            lines.append(f"{result['benchmark']:<20}{size:>9}  {result['error']}")
+            continue
+        comparison = ratios.get((result["benchmark"], result["size"]))
+        change = ""
+        if comparison:
+            change = f"{comparison['ratio']:.2f}x"
+            if comparison["regression"]:
+                change += " !"
+        throughput = f"{result['throughput']:.1f} {result['unit']}/s"
+        lines.append(
+            f"{result['benchmark']:<20}{size:>9}"
+            f"{result['p50_seconds'] * 1000:>11.2f}{result['p99_seconds'] * 1000:>11.2f}"
+            f"{throughput:>22}{result['peak_rss_mb']:>10.1f}{change:>14}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,220 @@
+"""
+faktotum.benchmarks.synthetic
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+This module implements generators for synthetic texts, knowledge bases and
+model checkpoints.
+"""
+
+import json
+import logging
+import random
+from pathlib import Path
+from typing import List, Tuple, Union
+
+from faktotum.typing import KnowledgeBaseDump
+
+FIRST_NAMES = (
+    "Anna Berta Clara Dora Emil Friedrich Gustav Hanna Ida Jakob Karl Luise "
+    "Martha Norbert Otto Paula Rudolf Sophie Theodor Ursula Viktor Wilhelm "
+    "Yvonne Zacharias Ernst Greta Heinrich Johanna Konrad Lotte"
+).split()
+LAST_NAMES = (
+    "Müller Schmidt Schneider Fischer Weber Meyer Wagner Becker Schulz "
+    "Hoffmann Schäfer Koch Bauer Richter Klein Wolf Schröder Neumann "
+    "Schwarz Zimmermann Braun Krüger Hofmann Hartmann Lange Schmitt Werner "
+    "Krause Meier Lehmann Köhler Herrmann König Walter Mayer"
+).split()
+COMPANIES = (
+    "Siemens Bosch Henkel Bayer Continental Merck Zeiss Linde Adidas "
+    "Beiersdorf Lufthansa Allianz Telekom"
+).split()
+PLACES = (
+    "Berlin Hamburg München Köln Frankfurt Stuttgart Leipzig Dresden Bremen "
+    "Hannover Nürnberg Würzburg"
+).split()
+# templates of sentences, `{PER}`, `{ORG}` and `{LOC}` are entity slots
+TEMPLATES = [
+    "{PER} fuhr am Montag mit dem Zug nach {LOC} .",
+    "Gestern hat {PER} einen langen Brief an {PER} geschrieben .",
+    "Der Vorstand von {ORG} hat {PER} zum neuen Leiter ernannt .",
+    "In {LOC} eröffnete {ORG} ein weiteres Werk mit vielen Arbeitsplätzen .",
+    "Niemand wusste , warum {PER} so früh das Haus verlassen hatte .",
+    "Die Aktie von {ORG} ist nach den Zahlen deutlich gestiegen .",
+    "{PER} und {PER} spazierten schweigend durch den verschneiten Park .",
+    "Am Abend las sie noch lange in dem alten Buch .",
+    "Der Sprecher von {ORG} wollte sich zu den Vorwürfen nicht äußern .",
+    "Es regnete seit Tagen , und die Straßen von {LOC} standen unter Wasser .",
+    "{PER} lächelte , als der Name {PER} fiel .",
+    "Die Verhandlungen zwischen {ORG} und {ORG} wurden vertagt .",
+]
+
+
+def _fill(template: str, rng: random.Random) -> Tuple[List[str], List[str]]:
+    words = list()
+    tags = list()
+    for slot in template.split():
+        if slot == "{PER}":
+            name = [rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)]
+            label = "PER"
+        elif slot == "{ORG}":
+            name = [rng.choice(COMPANIES)]
+            label = "ORG"
+        elif slot == "{LOC}":
+            name = [rng.choice(PLACES)]
+            label = "LOC"
+        else:
+            words.append(slot)
+            tags.append(None)
+            continue
+        words.extend(name)
+        tags.extend([f"B-{label}"] + [f"I-{label}"] * (len(name) - 1))
+    return words, tags
+
+
+def generate_sentences(
+    n_sentences: int, seed: int = 23
+) -> List[Tuple[List[str], List[str]]]:
+    """Generate German sentences with entity annotations.
+
+    Parameters
+    ----------
+    n_sentences : int
+        Number of sentences.
+    seed : int
+        Seed of the random generator.
+
+    Returns
+    -------
+    list
+        The words and BIO tags of each sentence, `None` for no entity.
+    """
+    rng = random.Random(seed)
+    return [_fill(rng.choice(TEMPLATES), rng) for _ in range(n_sentences)]
+
+
+def generate_text(n_sentences: int, seed: int = 23) -> str:
+    """Generate a German text of the given number of sentences."""
+    return " ".join(
+        " ".join(words[:-1]) + words[-1]
+        for words, _ in generate_sentences(n_sentences, seed)
+    )
+
+
+def generate_knowledge_base(
+    n_contexts: int, contexts_per_entity: int = 4, seed: int = 23
+) -> KnowledgeBaseDump:
+    """Generate a knowledge base of persons mentioned in synthetic contexts.
+
+    Entities share first and last names, so mentions have several
+    candidates, like in a real knowledge base.
+
+    Parameters
+    ----------
+    n_contexts : int
+        Total number of contexts.
+    contexts_per_entity : int
+        Number of contexts per entity.
+    seed : int
+        Seed of the random generator.
+
+    Returns
+    -------
+    KnowledgeBaseDump
+        The knowledge base, in the format of a dump.
+    """
+    rng = random.Random(seed)
+    templates = [template for template in TEMPLATES if "{PER}" in template]
+    data = dict()
+    for n in range(0, n_contexts, contexts_per_entity):
+        name = [rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)]
+        contexts = list()
+        indices = list()
+        for _ in range(min(contexts_per_entity, n_contexts - n)):
+            template = rng.choice(templates)
+            words, _ = _fill(template.replace("{PER}", "X", 1), rng)
+            slot = words.index("X")
+            contexts.append(words[:slot] + name + words[slot + 1 :])
+            indices.append([slot, slot + 1])
+        data[f"Q{n // contexts_per_entity}"] = {
+            "CONTEXTS": contexts,
+            "ENTITY_INDICES": indices,
+        }
+    return data
+
+
+def write_knowledge_base(
+    filepath: Union[str, Path],
+    n_contexts: int,
+    contexts_per_entity: int = 4,
+    seed: int = 23,
+) -> Path:
+    """Generate a knowledge base and write it as a JSON dump."""
+    filepath = Path(filepath)
+    logging.info(f"Generating knowledge base with {n_contexts} contexts...")
+    data = generate_knowledge_base(n_contexts, contexts_per_entity, seed)
+    with filepath.open("w", encoding="utf-8") as dump:
+        json.dump(data, dump, ensure_ascii=False)
+    return filepath
+
+
+def create_checkpoints(directory: Union[str, Path], seed: int = 23) -> dict:
+    """Create small, randomly initialized BERT checkpoints for offline runs.
+
+    The vocabulary covers the words of the synthetic texts, so tokenization
+    behaves like with a real model. The predictions are meaningless, but
+    the checkpoints exercise the full pipelines at a fraction of the cost.
+
+    Parameters
+    ----------
+    directory : str or Path
+        Directory the checkpoints are written to.
+    seed : int
+        Seed for the weight initialization.
+
+    Returns
+    -------
+    dict
+        Path of the checkpoint for `ner` and `ned`.
+    """
+    import torch
+    import transformers
+
+    directory = Path(directory)
+    paths = {task: Path(directory, task) for task in ("ner", "ned")}
+    if all(Path(path, "config.json").exists() for path in paths.values()):
+        return {task: str(path) for task, path in paths.items()}
+    logging.info(f"Creating benchmark checkpoints in {directory}...")
+    basic = transformers.BasicTokenizer(do_lower_case=True)
+    words = set()
+    for text in TEMPLATES + FIRST_NAMES + LAST_NAMES + COMPANIES + PLACES:
+        for slot in ("{PER}", "{ORG}", "{LOC}"):
+            text = text.replace(slot, "")
+        words.update(basic.tokenize(text))
+    characters = sorted(set("".join(words)) | set("0123456789"))
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+    vocab += sorted(words - set(characters)) + characters
+    vocab += [f"##{character}" for character in characters]
+    labels = ["O"] + [f"{p}-{label}" for label in ("PER", "ORG", "LOC") for p in "BI"]
+    config = transformers.BertConfig(
+        vocab_size=len(vocab),
+        hidden_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        intermediate_size=128,
+        id2label=dict(enumerate(labels)),
+        label2id={label: i for i, label in enumerate(labels)},
+    )
+    directory.mkdir(parents=True, exist_ok=True)
+    vocab_file = Path(directory, "vocab.txt")
+    vocab_file.write_text("\n".join(vocab), encoding="utf-8")
+    tokenizer = transformers.BertTokenizer(str(vocab_file), do_lower_case=True)
+    torch.manual_seed(seed)
+    models = {
+        "ner": transformers.BertForTokenClassification(config),
+        "ned": transformers.BertModel(config),
+    }
+    for task, model in models.items():
+        model.save_pretrained(str(paths[task]))
+        tokenizer.save_pretrained(str(paths[task]))
+    return {task: str(path) for task, path in paths.items()}
@@ -0,0 +1,330 @@
+"""
+faktotum.cli
+~~~~~~~~~~~~
+
+This module implements the command line interface.
+"""
+
+import argparse
+import logging
+import multiprocessing
+import multiprocessing.util
+import os
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from faktotum import tracing
+from faktotum.kb import KnowledgeBase
+from faktotum.pipelines import load_pipeline, nel_stream, ner_stream, preload
+from faktotum.profiling import timer
+
+FORMATS = {"jsonl": ".jsonl", "parquet": ".parquet"}
+
+_WORKER = dict()
+
+
+def _init_worker(
+    domain: str,
+    kb: Optional[str],
+    output_format: str,
+    threads: int,
+    options: dict,
+    trace: Optional[str] = None,
+):
+    import torch
+
+    if trace:
+        tracing.start(trace)
+        # pool workers exit through the multiprocessing finalizers
+        multiprocessing.util.Finalize(None, tracing.stop, exitpriority=10)
+    torch.set_num_threads(threads)
+    _WORKER["domain"] = domain
+    _WORKER["kb"] = KnowledgeBase.load(kb) if kb else None
+    _WORKER["format"] = output_format
+    _WORKER["options"] = options
+    # no-op if the models were preloaded in the parent before forking
+    load_pipeline("ner", domain, options["precision"], options["backend"])
+    if kb:
+        load_pipeline("ned", domain, options["precision"], options["backend"])
+
+
+def _process_document(paths: Tuple[Path, Path]) -> int:
+    source, target = paths
+    temporary = target.with_name(target.name + ".tmp")
+    kb = _WORKER["kb"]
+    tokens = 0
+    with source.open("r", encoding="utf-8") as text, timer(
+        "document", file=source.name
+    ):
+        if kb is None:
+            chunks = ner_stream(text, _WORKER["domain"], **_WORKER["options"])
+        else:
+            chunks = nel_stream(text, kb, _WORKER["domain"], **_WORKER["options"])
+        if _WORKER["format"] == "parquet":
+            tokens = _write_parquet(chunks, temporary)
+        else:
+            tokens = _write_jsonl(chunks, temporary)
+    temporary.replace(target)
+    return tokens
+
+
+def _write_jsonl(chunks, filepath: Path) -> int:
+    tokens = 0
+    with filepath.open("w", encoding="utf-8") as output:
+        for chunk in chunks:
+            with timer("serialization", tokens=len(chunk)):
+                if len(chunk):
+                    lines = chunk.to_json(
+                        orient="records", lines=True, force_ascii=False
+                    )
+                    # older pandas versions omit the final newline
+                    output.write(lines if lines.endswith("\n") else f"{lines}\n")
+            tokens += len(chunk)
+    return tokens
+
+
+def _write_parquet(chunks, filepath: Path) -> int:
+    import pyarrow
+    import pyarrow.parquet
+
+    tokens = 0
+    writer = None
+    for chunk in chunks:
+        with timer("serialization", tokens=len(chunk)):
+            if writer is None:
+                fields = [(column, pyarrow.string()) for column in chunk.columns]
+                fields[0] = ("sentence_id", pyarrow.int64())
+                schema = pyarrow.schema(fields)
+                writer = pyarrow.parquet.ParquetWriter(str(filepath), schema)
+            writer.write_table(
+                pyarrow.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+            )
+        tokens += len(chunk)
+    if writer is not None:
+        writer.close()
+    else:
+        filepath.touch()
+    return tokens
+
+
+def run(
+    input_dir: Path,
+    output_dir: Path,
+    domain: str,
+    kb: Optional[str] = None,
+    workers: int = 1,
+    output_format: str = "jsonl",
+    chunk_size: int = 1000,
+    batch_size: int = 16,
+    precision: str = "fp32",
+    backend: str = "torch",
+    trace: Optional[str] = None,
+) -> Tuple[int, int, float]:
+    """Process all text files of a directory with a pool of worker processes.
+
+    The models are loaded once in the parent process and shared with the
+    forked workers; each worker loads the knowledge base once. Documents
+    with complete output are skipped, so an interrupted run can be resumed.
+
+    Parameters
+    ----------
+    input_dir : Path
+        Directory with `.txt` files.
+    output_dir : Path
+        Directory for the results, one file per document.
+    domain : str
+        Domain of the texts, either `literary-texts` or `press-texts`.
+    kb : str, optional
+        Path to a knowledge base dump or binary directory. Without one,
+        only named entity recognition is performed.
+    workers : int
+        Number of worker processes.
+    output_format : str
+        Either `jsonl` or `parquet`.
+    chunk_size : int
+        Number of sentences processed and written at once.
+    batch_size : int
+        Number of sentences per forward pass.
+    precision : str
+        Numeric precision of the models, either `fp32` or `int8`.
+    backend : str
+        Either `torch` or `onnx`.
+    trace : str, optional
+        If set, spans of all processes are written to this file as Chrome
+        trace events.
+
+    Returns
+    -------
+    tuple
+        Number of documents and tokens processed, and the elapsed seconds.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    suffix = FORMATS[output_format]
+    tasks = list()
+    for source in sorted(input_dir.glob("*.txt")):
+        target = Path(output_dir, source.stem + suffix)
+        if target.exists():
+            logging.info(f"Skipping {source.name}, output is complete.")
+        else:
+            tasks.append((source, target))
+    logging.info(f"Processing {len(tasks)} documents with {workers} workers...")
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    options = {
+        "chunk_size": chunk_size,
+        "batch_size": batch_size,
+        "precision": precision,
+        "backend": backend,
+    }
+    if trace:
+        # parts left over by an interrupted run
+        for part in Path(trace).parent.glob(f"{Path(trace).name}.*.part"):
+            part.unlink()
+        tracing.start(trace)
+    if multiprocessing.get_start_method() == "fork":
+        with timer("preload"):
+            preload(domain, ["ner", "ned"] if kb else ["ner"], precision, backend)
+    start = time.perf_counter()
+    tokens = 0
+    with multiprocessing.Pool(
+        workers,
+        initializer=_init_worker,
+        initargs=(domain, kb, output_format, threads, options, trace),
+    ) as pool:
+        for count in pool.imap_unordered(_process_document, tasks):
+            tokens += count
+        # let the workers exit normally, so they write their spans
+        pool.close()
+        pool.join()
+    seconds = time.perf_counter() - start
+    if trace:
+        tracing.stop()
+        trace = Path(trace)
+        events = tracing.merge(trace.parent.glob(f"{trace.name}.*.part"), trace)
+        logging.info(f"Wrote {events} trace events to {trace}.")
+    return len(tasks), tokens, seconds
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="faktotum", description="Extract and disambiguate named entities."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    parser_run = commands.add_parser("run", help="Process a directory of texts.")
+    parser_run.add_argument("input", type=Path, help="Directory with .txt files.")
+    parser_run.add_argument("output", type=Path, help="Directory for the results.")
+    parser_run.add_argument(
+        "--domain",
+        required=True,
+        choices=["literary-texts", "press-texts"],
+        help="Domain of the texts.",
+    )
+    parser_run.add_argument(
+        "--kb", help="Knowledge base dump or binary directory to link entities."
+    )
+    parser_run.add_argument(
+        "--workers", type=int, default=1, help="Number of worker processes."
+    )
+    parser_run.add_argument(
+        "--format", default="jsonl", choices=list(FORMATS), help="Output format."
+    )
+    parser_run.add_argument(
+        "--chunk-size", type=int, default=1000, help="Sentences per chunk."
+    )
+    parser_run.add_argument(
+        "--batch-size", type=int, default=16, help="Sentences per forward pass."
+    )
+    parser_run.add_argument(
+        "--precision",
+        default="fp32",
+        choices=["fp32", "int8"],
+        help="Numeric precision of the models.",
+    )
+    parser_run.add_argument(
+        "--backend",
+        default="torch",
+        choices=["torch", "onnx"],
+        help="Inference backend.",
+    )
+    parser_run.add_argument(
+        "--trace", help="File to write a Chrome trace of the run to."
+    )
+    parser_serve = commands.add_parser(
+        "serve", help="Serve the pipelines over HTTP on this machine."
+    )
+    parser_serve.add_argument(
+        "--domain",
+        required=True,
+        choices=["literary-texts", "press-texts"],
+        help="Domain of the texts.",
+    )
+    parser_serve.add_argument(
+        "--kb", help="Knowledge base dump or binary directory to link entities."
+    )
+    parser_serve.add_argument(
+        "--host", default="127.0.0.1", help="Address to listen on."
+    )
+    parser_serve.add_argument("--port", type=int, default=8000, help="Port.")
+    parser_serve.add_argument(
+        "--max-batch-size", type=int, default=32, help="Requests per micro-batch."
+    )
+    parser_serve.add_argument(
+        "--max-wait",
+        type=float,
+        default=0.01,
+        help="Seconds a request waits for others to share its batch.",
+    )
+    parser_serve.add_argument(
+        "--batch-size", type=int, default=16, help="Sentences per forward pass."
+    )
+    parser_serve.add_argument(
+        "--precision",
+        default="fp32",
+        choices=["fp32", "int8"],
+        help="Numeric precision of the models.",
+    )
+    parser_serve.add_argument(
+        "--backend",
+        default="torch",
+        choices=["torch", "onnx"],
+        help="Inference backend.",
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        documents, tokens, seconds = run(
+            args.input,
+            args.output,
+            args.domain,
+            args.kb,
+            args.workers,
+            args.format,
+            args.chunk_size,
+            args.batch_size,
+            args.precision,
+            args.backend,
+            args.trace,
+        )
+        seconds = max(seconds, 1e-9)
+        print(
+            f"Processed {documents} documents and {tokens} tokens in {seconds:.1f}s "
+            f"({documents / seconds:.2f} documents/s, {tokens / seconds:.1f} tokens/s)."
+        )
+    elif args.command == "serve":
+        from faktotum.server import serve
+
+        serve(
+            args.domain,
+            args.kb,
+            args.host,
+            args.port,
+            args.max_batch_size,
+            args.max_wait,
+            args.batch_size,
+            args.precision,
+            args.backend,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+"""
+faktotum.index
+~~~~~~~~~~~~~~
+
+This module implements indices to look up candidates in knowledge bases.
+"""
+
+import logging
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from faktotum.utils import encode_strings, jaro_winkler_similarities, normalize
+
+EPSILON = 1e-9
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Return the positions of the k highest scores, best first."""
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+class VectorIndex:
+    """Inverted file index over unit vectors, searched by cosine similarity.
+
+    The vectors are clustered with spherical k-means and stored grouped by
+    their nearest centroid. A query only scores the vectors of the `n_probe`
+    closest clusters; more probes trade speed for recall.
+
+    Parameters
+    ----------
+    vectors : np.ndarray
+        Matrix with one unit vector per row.
+    identifiers : list
+        Entity identifier of each row.
+    positions : list
+        Position of each row's context in the entity's list of contexts.
+    n_lists : int, optional
+        Number of clusters, defaults to the square root of the number of rows.
+    n_probe : int
+        Number of clusters searched per query.
+    k : int
+        Number of neighbours returned per query.
+    n_iter : int
+        Number of k-means iterations.
+    seed : int
+        Seed for the k-means initialization.
+    """
+
+    def __init__(
+        self,
+        vectors: np.ndarray,
+        identifiers: List[str],
+        positions: List[int],
+        n_lists: Optional[int] = None,
+        n_probe: int = 8,
+        k: int = 100,
+        n_iter: int = 10,
+        seed: int = 23,
+    ):
+        # referenced, not copied, e.g. the memory-mapped embeddings
+        self.vectors = vectors
+        self.identifiers = np.asarray(identifiers, dtype=object)
+        self.positions = np.asarray(positions, dtype=np.int64)
+        self.n_probe = n_probe
+        self.k = k
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(len(self.vectors))))
+        n_lists = min(n_lists, len(self.vectors))
+        logging.info(f"Clustering {len(self.vectors)} vectors into {n_lists} lists...")
+        self.centroids = self._kmeans(n_lists, n_iter, np.random.RandomState(seed))
+        assignments = self._assign(self.vectors)
+        self.rows = np.argsort(assignments, kind="stable")
+        self.offsets = np.searchsorted(
+            assignments[self.rows], np.arange(len(self.centroids) + 1)
+        )
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @property
+    def scan_size(self) -> int:
+        """Average number of rows scored per query."""
+        return int(np.ceil(len(self.vectors) * self.n_probe / len(self.centroids)))
+
+    def _assign(self, vectors: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), chunk_size):
+            chunk = vectors[start : start + chunk_size]
+            assignments[start : start + chunk_size] = np.argmax(
+                chunk @ self.centroids.T, axis=1
+            )
+        return assignments
+
+    def _kmeans(
+        self, n_lists: int, n_iter: int, random_state: np.random.RandomState
+    ) -> np.ndarray:
+        sample_size = min(len(self.vectors), 256 * n_lists)
+        sample = self.vectors[
+            random_state.choice(len(self.vectors), sample_size, replace=False)
+        ]
+        self.centroids = sample[
+            random_state.choice(sample_size, n_lists, replace=False)
+        ].copy()
+        for _ in range(n_iter):
+            assignments = self._assign(sample)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assignments, sample)
+            empty = np.bincount(assignments, minlength=n_lists) == 0
+            sums[empty] = sample[random_state.choice(sample_size, empty.sum())]
+            self.centroids = normalize(sums)
+        return self.centroids
+
+    def search(
+        self, vector: np.ndarray, k: Optional[int] = None, n_probe: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Approximate search for the rows most similar to a vector.
+
+        Parameters
+        ----------
+        vector : np.ndarray
+            The query vector.
+        k : int, optional
+            Number of neighbours, defaults to the index setting.
+        n_probe : int, optional
+            Number of clusters to search, defaults to the index setting.
+
+        Returns
+        -------
+        tuple
+            Row numbers and cosine similarities, best first.
+        """
+        k = k or self.k
+        n_probe = n_probe or self.n_probe
+        query = normalize(vector)
+        lists = top_k(self.centroids @ query, n_probe)
+        rows = np.concatenate(
+            [self.rows[self.offsets[i] : self.offsets[i + 1]] for i in lists]
+        )
+        scores = self.vectors[rows] @ query
+        best = top_k(scores, k)
+        return rows[best], scores[best]
+
+    def exact_search(
+        self, vector: np.ndarray, k: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Exhaustive search for the rows most similar to a vector.
+
+        Parameters
+        ----------
+        vector : np.ndarray
+            The query vector.
+        k : int, optional
+            Number of neighbours, defaults to the index setting.
+
+        Returns
+        -------
+        tuple
+            Row numbers and cosine similarities, best first.
+        """
+        scores = self.vectors @ normalize(vector)
+        best = top_k(scores, k or self.k)
+        return best, scores[best]
+
+    def recall(
+        self,
+        queries: np.ndarray,
+        k: Optional[int] = None,
+        n_probe: Optional[int] = None,
+    ) -> float:
+        """Fraction of the exact top k neighbours found by the approximate search.
+
+        Parameters
+        ----------
+        queries : np.ndarray
+            Matrix with one query vector per row.
+        k : int, optional
+            Number of neighbours, defaults to the index setting.
+        n_probe : int, optional
+            Number of clusters to search, defaults to the index setting.
+
+        Returns
+        -------
+        float
+            The mean recall over all queries.
+        """
+        found = 0
+        total = 0
+        for query in queries:
+            exact, _ = self.exact_search(query, k)
+            approximate, _ = self.search(query, k, n_probe)
+            found += len(np.intersect1d(exact, approximate))
+            total += len(exact)
+        return found / total if total else 1.0
+
+
+def jaro_winkler_bound(
+    matches: np.ndarray, length: int, lengths: np.ndarray
+) -> np.ndarray:
+    """Upper bound of the Jaro-Winkler similarity for a number of shared characters.
+
+    The Jaro similarity is highest without transpositions, and the Winkler
+    boost is highest if the common prefix covers all matching characters.
+
+    Parameters
+    ----------
+    matches : np.ndarray
+        Upper bound of the matching characters for each candidate.
+    length : int
+        Length of the query.
+    lengths : np.ndarray
+        Length of each candidate.
+
+    Returns
+    -------
+    np.ndarray
+        The upper bound for each candidate.
+    """
+    matches = np.minimum(matches, np.minimum(length, lengths)).astype(np.float64)
+    jaro = np.where(matches > 0, (matches / length + matches / lengths + 1) / 3, 0.0)
+    longest = np.maximum(length, lengths)
+    boost = np.minimum(np.minimum(0.1, 1.0 / longest) * matches, 1.0)
+    return np.where(jaro > 0.7, jaro + boost * (1 - jaro), jaro)
+
+
+class SurfaceIndex:
+    """Inverted character index over the surface forms of a knowledge base.
+
+    Surfaces are lowercased and stored once, sorted by length. Every surface
+    is indexed by its characters together with their occurrence count, e.g.
+    `anna` by `a1`, `n1`, `n2` and `a2`, so the number of keys two strings
+    share is the size of their character multiset intersection. This is an
+    upper bound for the number of Jaro matches, which together with the
+    lengths bounds the Jaro-Winkler similarity before it is computed.
+
+    Parameters
+    ----------
+    surfaces : list
+        Surface form of each knowledge base row.
+    identifiers : list
+        Entity identifier of each row.
+    positions : list
+        Position of each row's context in the entity's list of contexts.
+    """
+
+    def __init__(
+        self, surfaces: List[str], identifiers: List[str], positions: List[int]
+    ):
+        self.identifiers = np.asarray(identifiers, dtype=object)
+        self.positions = np.asarray(positions, dtype=np.int64)
+        unique = sorted(set(surface.lower() for surface in surfaces), key=len)
+        ids = {surface: i for i, surface in enumerate(unique)}
+        self.surfaces = unique
+        self.codes, self.lengths = encode_strings(unique)
+        rows = [list() for _ in unique]
+        for row, surface in enumerate(surfaces):
+            rows[ids[surface.lower()]].append(row)
+        self.rows = [np.array(r, dtype=np.int64) for r in rows]
+        postings = dict()
+        for i, surface in enumerate(unique):
+            for key in self._keys(surface):
+                postings.setdefault(key, list()).append(i)
+        self.postings = {
+            key: np.array(value, dtype=np.int64) for key, value in postings.items()
+        }
+
+    def __len__(self):
+        return len(self.surfaces)
+
+    @staticmethod
+    def _keys(text: str) -> List[Tuple[str, int]]:
+        counts = dict()
+        keys = list()
+        for char in text:
+            counts[char] = counts.get(char, 0) + 1
+            keys.append((char, counts[char]))
+        return keys
+
+    def candidates(self, mention: str, threshold: float) -> List[int]:
+        """Surfaces that might reach the threshold.
+
+        Parameters
+        ----------
+        mention : str
+            The mention to look up.
+        threshold : float
+            Minimum Jaro-Winkler similarity.
+
+        Returns
+        -------
+        list
+            Identifiers of the surfaces whose upper bound reaches the
+            threshold.
+        """
+        if threshold <= 0:
+            return list(range(len(self)))
+        mention = mention.lower()
+        length = len(mention)
+        if length == 0:
+            return [i for i, surface in enumerate(self.surfaces) if not surface]
+        possible = np.arange(self.lengths[-1] + 1) if len(self) else np.arange(1)
+        feasible = possible[
+            jaro_winkler_bound(possible, length, np.maximum(possible, 1))
+            >= threshold - EPSILON
+        ]
+        if not len(feasible):
+            return list()
+        start = np.searchsorted(self.lengths, max(feasible.min(), 1), side="left")
+        end = np.searchsorted(self.lengths, feasible.max(), side="right")
+        if start >= end:
+            return list()
+        postings = list()
+        for key in self._keys(mention):
+            posting = self.postings.get(key)
+            if posting is not None:
+                postings.append(
+                    posting[
+                        np.searchsorted(posting, start) : np.searchsorted(posting, end)
+                    ]
+                )
+        if not postings:
+            return list()
+        matches = np.bincount(np.concatenate(postings) - start, minlength=end - start)
+        bounds = jaro_winkler_bound(matches, length, self.lengths[start:end])
+        return (np.flatnonzero(bounds >= threshold - EPSILON) + start).tolist()
+
+    def search(self, mention: str, threshold: float) -> np.ndarray:
+        """Knowledge base rows whose surface reaches the threshold.
+
+        Parameters
+        ----------
+        mention : str
+            The mention to look up.
+        threshold : float
+            Minimum Jaro-Winkler similarity.
+
+        Returns
+        -------
+        np.ndarray
+            The matching rows in knowledge base order.
+        """
+        mention = mention.lower()
+        candidates = self.candidates(mention, threshold)
+        scores = jaro_winkler_similarities(
+            mention, self.codes[candidates], self.lengths[candidates]
+        )
+        rows = [
+            self.rows[i] for i, score in zip(candidates, scores) if score >= threshold
+        ]
+        if not rows:
+            return np.array([], dtype=np.int64)
+        return np.sort(np.concatenate(rows))
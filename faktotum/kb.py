@@ -5,22 +5,149 @@ faktotum.kb
 This module implements a basic class for knowledge bases.
 """
 
+import hashlib
+import json
 import logging
+from collections.abc import Mapping
 from pathlib import Path
-from typing import Union
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
-from faktotum.typing import KnowledgeBaseDump
+import numpy as np
+
+from faktotum.index import SurfaceIndex, VectorIndex
+from faktotum.profiling import count
+from faktotum.typing import KnowledgeBaseDump, Pipeline
+from faktotum.utils import normalize, vectorize_contexts
+
+# bump if the way context embeddings are computed changes, so stores
+# written by earlier versions are rebuilt
+EMBEDDINGS_VERSION = 2
+# bump if the layout of binary knowledge bases changes
+BINARY_VERSION = 1
+# arrays of a binary knowledge base, each stored as `<name>.npy`
+BINARY_ARRAYS = (
+    "entities",
+    "offsets",
+    "identifiers",
+    "positions",
+    "vocabulary",
+    "vocabulary_offsets",
+    "tokens",
+    "context_offsets",
+    "entity_indices",
+    "entity_index_offsets",
+)
+
+
+def _offsets(lengths: List[int]) -> np.ndarray:
+    return np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+
+
+def _checksum(identifiers: Iterable[str], offsets: Iterable[int]) -> str:
+    # identifies the layout of the embedding rows, so stores of another
+    # version of the knowledge base are detected without storing the layout
+    digest = hashlib.sha1("\0".join(identifiers).encode("utf-8"))
+    digest.update(np.asarray(offsets, dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+
+class MappedData(Mapping):
+    """Read-only view of a knowledge base saved with `save_binary`.
+
+    Behaves like the dictionary of a dump, but all arrays are memory-mapped
+    and contexts are only decoded when accessed. Tokens are stored as ids
+    into a vocabulary of UTF-8 encoded words.
+
+    Parameters
+    ----------
+    directory : str or Path
+        The directory of the binary knowledge base.
+    """
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+        for name in BINARY_ARRAYS:
+            array = np.load(Path(self.directory, f"{name}.npy"), mmap_mode="r")
+            setattr(self, name, array)
+        self._words = dict()
+        self._rows = None
+
+    def __getitem__(self, identifier: str) -> Dict[str, List[List]]:
+        if self._rows is None:
+            self._rows = {str(entity): i for i, entity in enumerate(self.entities)}
+        i = self._rows[identifier]
+        contexts = [self.context(row) for row in range(*self.offsets[i : i + 2])]
+        return {
+            "CONTEXTS": [context for context, _ in contexts],
+            "ENTITY_INDICES": [index for _, index in contexts],
+        }
+
+    def __iter__(self) -> Iterator[str]:
+        return (str(entity) for entity in self.entities)
+
+    def __len__(self):
+        return len(self.entities)
+
+    def _word(self, i: int) -> str:
+        word = self._words.get(i)
+        if word is None:
+            start, end = self.vocabulary_offsets[i : i + 2]
+            word = self.vocabulary[start:end].tobytes().decode("utf-8")
+            self._words[i] = word
+        return word
+
+    def context(self, row: int) -> Tuple[List[str], List[int]]:
+        """Return the context and entity indices of a row."""
+        start, end = self.context_offsets[row : row + 2]
+        context = [self._word(i) for i in self.tokens[start:end].tolist()]
+        start, end = self.entity_index_offsets[row : row + 2]
+        return context, self.entity_indices[start:end].tolist()
+
+    def surfaces(self) -> List[str]:
+        """Return the entity surface form of every row."""
+        lengths = np.diff(self.entity_index_offsets)
+        starts = np.repeat(self.context_offsets[:-1], lengths)
+        ids = self.tokens[starts + self.entity_indices].tolist()
+        bounds = self.entity_index_offsets.tolist()
+        return [
+            " ".join(self._word(i) for i in ids[start:end])
+            for start, end in zip(bounds, bounds[1:])
+        ]
 
 
 class KnowledgeBase:
-    def __init__(self, data: KnowledgeBaseDump):
+    """Knowledge base with one embedding row per context.
+
+    The context embeddings are kept in one contiguous, L2-normalized float32
+    matrix `embeddings`. Rows are ordered like the entities in `data`, and
+    `identifiers` holds the entity identifier of every row.
+    """
+
+    def __init__(
+        self,
+        data: Union[KnowledgeBaseDump, MappedData],
+        filepath: Optional[Union[str, Path]] = None,
+    ):
         self.data = data
-        for identifier, knowledge in self.data.items():
-            for context in knowledge["CONTEXTS"]:
-                if "EMBEDDINGS" not in self.data[identifier]:
-                    self.data[identifier]["EMBEDDINGS"] = [None]
-                else:
-                    self.data[identifier]["EMBEDDINGS"].append(None)
+        self.filepath = Path(filepath) if filepath else None
+        self.model_name = None
+        self.index = None
+        self.surface_index = None
+        if isinstance(data, MappedData):
+            self.offsets = data.offsets
+            self.identifiers = data.identifiers
+            self.positions = data.positions
+        else:
+            lengths = [len(knowledge["CONTEXTS"]) for knowledge in self.data.values()]
+            self.offsets = _offsets(lengths)
+            self.identifiers = np.repeat(
+                np.array(list(self.data), dtype=object), lengths
+            )
+            self.positions = np.arange(self.offsets[-1]) - np.repeat(
+                self.offsets[:-1], lengths
+            )
+        self.embeddings = None
+        self.vectorized = np.zeros(self.offsets[-1], dtype=bool)
 
     def __len__(self):
         return len(self.data)
@@ -31,4 +158,389 @@ class KnowledgeBase:
         logging.info(f"Loading knowledge base from {filepath.name}...")
         with filepath.open("r", encoding="utf-8") as dump:
             data = json.load(dump)
-            return cls(data)
+        kb = cls(data, filepath)
+        if kb._metadata_path(filepath).exists():
+            kb.load_embeddings()
+        return kb
+
+    @classmethod
+    def load(cls, filepath: Union[str, Path]):
+        """Load a binary knowledge base directory or a JSON dump."""
+        if Path(filepath).is_dir():
+            return cls.load_binary(filepath)
+        return cls.from_dump(filepath)
+
+    @classmethod
+    def load_binary(cls, directory: Union[str, Path]):
+        """Open a knowledge base saved with `save_binary`.
+
+        Nothing is parsed or copied: the arrays, and the embeddings if
+        saved, are memory-mapped, so opening takes constant time and
+        processes opening the same directory share the pages.
+
+        Parameters
+        ----------
+        directory : str or Path
+            The directory of the binary knowledge base.
+        """
+        directory = Path(directory)
+        logging.info(f"Opening knowledge base {directory.name}...")
+        metadata_path = Path(directory, "metadata.json")
+        if not metadata_path.exists():
+            raise ValueError(f"{directory} is not a binary knowledge base.")
+        metadata = json.loads(metadata_path.read_text(encoding="utf-8"))
+        if metadata.get("version") != BINARY_VERSION:
+            raise ValueError(
+                f"{directory} has version {metadata.get('version')}, "
+                f"expected {BINARY_VERSION}. Save it again with save_binary()."
+            )
+        kb = cls(MappedData(directory), directory)
+        embeddings = metadata.get("embeddings")
+        if embeddings and embeddings["version"] == EMBEDDINGS_VERSION:
+            kb.embeddings = np.load(Path(directory, "embeddings.npy"), mmap_mode="r")
+            kb.vectorized[:] = True
+            kb.model_name = embeddings["model"]
+        elif embeddings:
+            logging.warning(f"Embeddings in {directory.name} are out of date.")
+        elif kb._metadata_path(directory).exists():
+            # built with build_embeddings() after opening
+            kb.load_embeddings()
+        return kb
+
+    def save_binary(self, directory: Union[str, Path]):
+        """Save the knowledge base in a compact, memory-mappable layout.
+
+        The directory holds one `.npy` file per array: the entity and row
+        identifiers, an interned vocabulary, the token ids and entity
+        indices of all contexts with their offsets, and, if all contexts
+        are vectorized, the embeddings. The metadata is written last, so an
+        interrupted run leaves no loadable knowledge base behind.
+
+        Parameters
+        ----------
+        directory : str or Path
+            The directory, created if it does not exist.
+        """
+        directory = Path(directory)
+        if isinstance(self.data, MappedData) and directory.resolve() == (
+            self.data.directory.resolve()
+        ):
+            raise ValueError("Cannot overwrite the files the knowledge base maps.")
+        directory.mkdir(parents=True, exist_ok=True)
+        metadata_path = Path(directory, "metadata.json")
+        if metadata_path.exists():
+            metadata_path.unlink()
+        logging.info(f"Saving knowledge base to {directory.name}...")
+        vocabulary = dict()
+        tokens = list()
+        context_lengths = list()
+        entity_indices = list()
+        index_lengths = list()
+        for row in range(len(self.identifiers)):
+            context, index = self._context(row)
+            tokens.extend(
+                vocabulary.setdefault(word, len(vocabulary)) for word in context
+            )
+            context_lengths.append(len(context))
+            entity_indices.extend(index)
+            index_lengths.append(len(index))
+        words = [word.encode("utf-8") for word in vocabulary]
+        arrays = {
+            "entities": np.array(list(self.data), dtype=str),
+            "offsets": np.asarray(self.offsets, dtype=np.int64),
+            "identifiers": np.asarray(self.identifiers, dtype=str),
+            "positions": np.asarray(self.positions, dtype=np.int64),
+            "vocabulary": np.frombuffer(b"".join(words), dtype=np.uint8),
+            "vocabulary_offsets": _offsets([len(word) for word in words]),
+            "tokens": np.array(tokens, dtype=np.int32),
+            "context_offsets": _offsets(context_lengths),
+            "entity_indices": np.array(entity_indices, dtype=np.int32),
+            "entity_index_offsets": _offsets(index_lengths),
+        }
+        for name, array in arrays.items():
+            np.save(Path(directory, f"{name}.npy"), array)
+        metadata = {"version": BINARY_VERSION, "embeddings": None}
+        if self.embeddings is not None and self.vectorized.all():
+            np.save(Path(directory, "embeddings.npy"), self.embeddings)
+            metadata["embeddings"] = {
+                "model": self.model_name,
+                "version": EMBEDDINGS_VERSION,
+            }
+        metadata_path.write_text(json.dumps(metadata), encoding="utf-8")
+
+    @staticmethod
+    def _embeddings_path(filepath: Path) -> Path:
+        return filepath.with_suffix(".embeddings.npy")
+
+    @staticmethod
+    def _metadata_path(filepath: Path) -> Path:
+        return filepath.with_suffix(".embeddings.json")
+
+    def _context(self, row: int):
+        if isinstance(self.data, MappedData):
+            return self.data.context(row)
+        knowledge = self.data[self.identifiers[row]]
+        position = self.positions[row]
+        return knowledge["CONTEXTS"][position], knowledge["ENTITY_INDICES"][position]
+
+    def _read_metadata(self, filepath: Path, model_name: Optional[str] = None):
+        metadata_path = self._metadata_path(filepath)
+        if not metadata_path.exists():
+            return None
+        metadata = json.loads(metadata_path.read_text(encoding="utf-8"))
+        if model_name is not None and metadata["model"] != model_name:
+            logging.warning(
+                f"Embeddings in {metadata_path.name} were computed with "
+                f"{metadata['model']}, not {model_name}."
+            )
+            return None
+        if (
+            metadata.get("version") != EMBEDDINGS_VERSION
+            or not metadata.get("normalized")
+            or metadata.get("checksum") != _checksum(self.data, self.offsets)
+        ):
+            logging.warning(f"Embeddings in {metadata_path.name} are out of date.")
+            return None
+        return metadata
+
+    def _write_metadata(self, filepath: Path, metadata: dict):
+        metadata_path = self._metadata_path(filepath)
+        temporary = metadata_path.with_suffix(".tmp")
+        temporary.write_text(json.dumps(metadata), encoding="utf-8")
+        temporary.replace(metadata_path)
+
+    def reset_embeddings(self):
+        """Drop all context embeddings, e.g. after switching the model."""
+        self.embeddings = None
+        self.vectorized[:] = False
+        self.model_name = None
+        self.index = None
+
+    def missing(self, rows: np.ndarray) -> np.ndarray:
+        """Return the unique rows that are not vectorized yet."""
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        return rows[~self.vectorized[rows]]
+
+    def contexts(self, rows: np.ndarray) -> Tuple[List[List[str]], List[List[int]]]:
+        """Return the contexts and entity indices of the given rows."""
+        if not len(rows):
+            return list(), list()
+        contexts, indices = zip(*(self._context(row) for row in rows))
+        return list(contexts), list(indices)
+
+    def add_embeddings(self, rows: np.ndarray, vectors: List[np.ndarray]):
+        """Store the (unnormalized) embeddings of the given rows.
+
+        Parameters
+        ----------
+        rows : np.ndarray
+            The rows.
+        vectors : list
+            One pooled context embedding per row.
+        """
+        if not len(rows):
+            return
+        if self.embeddings is None:
+            self.embeddings = np.zeros(
+                (len(self.vectorized), len(vectors[0])), dtype=np.float32
+            )
+        self.embeddings[rows] = normalize(np.stack(vectors))
+        self.vectorized[rows] = True
+        count("kb_embeddings", len(rows))
+
+    def vectorize(
+        self,
+        rows: np.ndarray,
+        pipeline: Pipeline,
+        batch_size: int = 32,
+        max_tokens: Optional[int] = None,
+    ):
+        """Compute the embeddings of the given rows, if not done yet.
+
+        Parameters
+        ----------
+        rows : np.ndarray
+            The rows to vectorize.
+        pipeline : Pipeline
+            The feature extraction pipeline.
+        batch_size : int
+            Maximum number of contexts per forward pass.
+        max_tokens : int, optional
+            Maximum number of tokens per forward pass.
+        """
+        missing = self.missing(rows)
+        contexts, indices = self.contexts(missing)
+        if contexts:
+            vectors = vectorize_contexts(
+                pipeline, contexts, indices, batch_size, max_tokens
+            )
+            self.add_embeddings(missing, vectors)
+
+    def load_embeddings(
+        self,
+        filepath: Optional[Union[str, Path]] = None,
+        model_name: Optional[str] = None,
+    ) -> bool:
+        """Memory-map precomputed context embeddings.
+
+        Parameters
+        ----------
+        filepath : str or Path, optional
+            Path to the knowledge base dump, defaults to the one the
+            knowledge base was loaded from.
+        model_name : str, optional
+            If set, embeddings computed with another model are ignored.
+
+        Returns
+        -------
+        bool
+            True if complete embeddings were found and attached.
+        """
+        filepath = Path(filepath) if filepath else self.filepath
+        metadata = self._read_metadata(filepath, model_name)
+        if metadata is None or metadata["progress"] < metadata["contexts"]:
+            return False
+        logging.info(f"Memory-mapping embeddings computed with {metadata['model']}...")
+        self.embeddings = np.load(self._embeddings_path(filepath), mmap_mode="r")
+        self.vectorized[:] = True
+        self.model_name = metadata["model"]
+        return True
+
+    def build_embeddings(
+        self,
+        domain: str,
+        batch_size: int = 32,
+        filepath: Optional[Union[str, Path]] = None,
+        precision: str = "fp32",
+        backend: str = "torch",
+    ):
+        """Vectorize all contexts in batches and save them next to the dump.
+
+        The embeddings are written as normalized float32 matrix with one row
+        per context, together with a checksum of the entities and their
+        number of contexts. Progress is checkpointed after every batch by
+        rewriting a small metadata file, so an interrupted run resumes
+        where it stopped. Existing embeddings computed with another model or
+        for another version of the knowledge base are rebuilt.
+
+        Parameters
+        ----------
+        domain : str
+            Domain of the knowledge base, either `literary-texts` or
+            `press-texts`.
+        batch_size : int
+            Number of contexts per forward pass.
+        filepath : str or Path, optional
+            Path to the knowledge base dump, defaults to the one the
+            knowledge base was loaded from. If there is none, the embeddings
+            are only kept in memory.
+        precision : str
+            Numeric precision of the model, either `fp32` or `int8`.
+        backend : str
+            Either `torch` or `onnx`.
+        """
+        from faktotum.models import embeddings_key
+        from faktotum.pipelines import load_pipeline
+
+        pipeline = load_pipeline("ned", domain, precision, backend)
+        model_name = embeddings_key(domain, precision, backend)
+        filepath = Path(filepath) if filepath else self.filepath
+        shape = (len(self.vectorized), pipeline.model.config.hidden_size)
+
+        metadata = None
+        if filepath:
+            metadata = self._read_metadata(filepath, model_name)
+        if metadata is not None:
+            matrix = np.lib.format.open_memmap(
+                self._embeddings_path(filepath), mode="r+"
+            )
+            logging.info(f"Resuming from context {metadata['progress']}...")
+        elif filepath:
+            matrix = np.lib.format.open_memmap(
+                self._embeddings_path(filepath),
+                mode="w+",
+                dtype=np.float32,
+                shape=shape,
+            )
+            metadata = {
+                "model": model_name,
+                "version": EMBEDDINGS_VERSION,
+                "normalized": True,
+                "checksum": _checksum(self.data, self.offsets),
+                "contexts": len(matrix),
+                "progress": 0,
+            }
+        else:
+            matrix = np.empty(shape, dtype=np.float32)
+            metadata = {"progress": 0}
+
+        logging.info("Vectorizing knowledge base contexts...")
+        for start in range(metadata["progress"], len(matrix), batch_size):
+            end = min(start + batch_size, len(matrix))
+            contexts, indices = zip(*(self._context(row) for row in range(start, end)))
+            matrix[start:end] = normalize(
+                vectorize_contexts(pipeline, contexts, indices, batch_size)
+            )
+            if filepath:
+                matrix.flush()
+                metadata["progress"] = end
+                self._write_metadata(filepath, metadata)
+
+        if filepath:
+            del matrix
+            self.load_embeddings(filepath, model_name)
+        else:
+            self.embeddings = matrix
+            self.vectorized[:] = True
+            self.model_name = model_name
+
+    def build_index(
+        self, n_lists: Optional[int] = None, n_probe: int = 8, k: int = 100
+    ) -> VectorIndex:
+        """Build an approximate nearest neighbour index over the embeddings.
+
+        Once built, candidates are looked up in the index instead of
+        comparing the mention with every context of the knowledge base.
+
+        Parameters
+        ----------
+        n_lists : int, optional
+            Number of clusters, defaults to the square root of the number of
+            contexts.
+        n_probe : int
+            Number of clusters searched per mention. Higher values increase
+            recall at the cost of speed.
+        k : int
+            Number of most similar contexts considered per mention.
+
+        Returns
+        -------
+        VectorIndex
+            The index, also available as `kb.index`.
+        """
+        if not self.vectorized.all():
+            raise ValueError("Call build_embeddings() before build_index().")
+        self.index = VectorIndex(
+            self.embeddings, self.identifiers, self.positions, n_lists, n_probe, k
+        )
+        return self.index
+
+    def build_surface_index(self) -> SurfaceIndex:
+        """Index the entity surface forms of all contexts by their characters.
+
+        Returns
+        -------
+        SurfaceIndex
+            The index, also available as `kb.surface_index`.
+        """
+        if isinstance(self.data, MappedData):
+            surfaces = self.data.surfaces()
+        else:
+            surfaces = list()
+            for knowledge in self.data.values():
+                for context, index in zip(
+                    knowledge["CONTEXTS"], knowledge["ENTITY_INDICES"]
+                ):
+                    surfaces.append(" ".join(context[j] for j in index))
+        self.surface_index = SurfaceIndex(surfaces, self.identifiers, self.positions)
+        return self.surface_index
@@ -5,10 +5,12 @@ faktotum.models
 This module implements two model classes for named entity recognition and disambiguation.
 """
 
+import inspect
 import logging
+import os
+from pathlib import Path
 
-import transformers
-
+from faktotum.profiling import timer
 from faktotum.typing import Pipeline
 
 MODEL_NAMES = {
@@ -21,10 +23,237 @@ MODEL_NAMES = {
         "press-texts": "severinsimmler/bert-adapted-german-press",
     },
 }
+PRECISIONS = ("fp32", "int8")
+BACKENDS = ("torch", "onnx")
+CACHE_DIR = Path(os.environ.get("FAKTOTUM_CACHE", Path.home() / ".cache" / "faktotum"))
+
+
+def _slug(model_name: str) -> str:
+    return model_name.strip("/").replace("/", "--")
+
+
+def embeddings_key(domain: str, precision: str = "fp32", backend: str = "torch") -> str:
+    """Return the key knowledge base embeddings of a NED model are stored under.
+
+    Quantized and ONNX models compute slightly different vectors, so their
+    embeddings are kept apart from the full precision ones, which keep the
+    plain model name.
+    """
+    model_name = MODEL_NAMES["ned"][domain.lower()]
+    if (precision, backend) == ("fp32", "torch"):
+        return model_name
+    return f"{model_name} ({precision}, {backend})"
+
+
+def load_quantized_model(model_name: str, task: str):
+    """Load a model with its linear layers quantized to INT8.
+
+    Weights of the linear layers are stored as 8-bit integers and
+    activations are quantized on the fly, which speeds up inference on
+    CPUs. The quantized model is cached on disk, so later runs neither
+    load the full precision weights nor quantize them again.
+
+    Parameters
+    ----------
+    model_name : str
+        Name or path of the pretrained model.
+    task : str
+        Either `ner` for a token classification model or `ned` for the
+        plain encoder.
+
+    Returns
+    -------
+    The quantized model.
+    """
+    import torch
+    import transformers
+
+    filepath = Path(
+        CACHE_DIR, f"{_slug(model_name)}-{task}-int8-torch-{torch.__version__}.pt"
+    )
+    if filepath.exists():
+        logging.info(f"Loading quantized model from {filepath.name}...")
+        try:
+            return torch.load(filepath, weights_only=False)
+        except TypeError:
+            # older versions of torch always unpickle the whole object
+            return torch.load(filepath)
+    if task == "ner":
+        model = transformers.AutoModelForTokenClassification.from_pretrained(model_name)
+    else:
+        model = transformers.AutoModel.from_pretrained(model_name)
+    logging.info("Quantizing linear layers to INT8...")
+    model = torch.quantization.quantize_dynamic(
+        model.eval(), {torch.nn.Linear}, dtype=torch.qint8
+    )
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    temporary = filepath.with_suffix(".tmp")
+    torch.save(model, temporary)
+    temporary.replace(filepath)
+    return model
+
+
+class OnnxModel:
+    """ONNX Runtime session standing in for a PyTorch model.
+
+    Parameters
+    ----------
+    filepath : Path
+        Path to the exported model.
+    config : transformers.PretrainedConfig
+        Configuration of the original model.
+    """
+
+    def __init__(self, filepath: Path, config):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        self.session = onnxruntime.InferenceSession(
+            str(filepath), options, providers=["CPUExecutionProvider"]
+        )
+        self.config = config
+
+    def __call__(self, input_ids, attention_mask):
+        return self.session.run(
+            ["output"], {"input_ids": input_ids, "attention_mask": attention_mask}
+        )
+
+
+class OnnxPipeline:
+    """Tokenizer and ONNX model, with the attributes of a transformers pipeline
+    used by faktotum."""
+
+    def __init__(self, model: OnnxModel, tokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+
+
+def export_onnx_model(model_name: str, task: str, tolerance: float = 1e-4) -> Path:
+    """Export a model to ONNX with dynamic batch and sequence axes.
+
+    The model is exported once, together with its tokenizer and config, so
+    it can be loaded later without the original checkpoint. Before saving,
+    the outputs of the exported model are compared with PyTorch.
+
+    Parameters
+    ----------
+    model_name : str
+        Name or path of the pretrained model.
+    task : str
+        Either `ner` for a token classification model or `ned` for the
+        plain encoder.
+    tolerance : float
+        Maximum absolute difference to the PyTorch outputs.
+
+    Returns
+    -------
+    Path
+        The directory with `model.onnx`, the tokenizer and the config.
+    """
+    import numpy as np
+    import torch
+    import transformers
+
+    directory = Path(CACHE_DIR, f"{_slug(model_name)}-{task}-onnx")
+    filepath = Path(directory, "model.onnx")
+    if filepath.exists():
+        return directory
+    logging.info(f"Exporting {model_name} to ONNX...")
+    tokenizer = transformers.AutoTokenizer.from_pretrained(model_name)
+    if task == "ner":
+        model = transformers.AutoModelForTokenClassification.from_pretrained(model_name)
+    else:
+        model = transformers.AutoModel.from_pretrained(model_name)
+    model.eval()
+    inputs = tokenizer(
+        ["Das ist ein Beispiel .", "Noch ein Satz ."],
+        padding=True,
+        return_tensors="pt",
+    )
+    input_ids = inputs["input_ids"]
+    attention_mask = inputs["attention_mask"]
+    directory.mkdir(parents=True, exist_ok=True)
+    temporary = filepath.with_suffix(".tmp")
+    axes = {0: "batch", 1: "sequence"}
+    options = dict()
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # the TorchScript based exporter does not require onnxscript
+        options["dynamo"] = False
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (input_ids, attention_mask),
+            str(temporary),
+            input_names=["input_ids", "attention_mask"],
+            output_names=["output"],
+            dynamic_axes={"input_ids": axes, "attention_mask": axes, "output": axes},
+            opset_version=14,
+            **options,
+        )
+        expected = model(input_ids=input_ids, attention_mask=attention_mask)[0]
+    actual = OnnxModel(temporary, model.config)(
+        input_ids.numpy(), attention_mask.numpy()
+    )[0]
+    deviation = float(np.abs(actual - expected.numpy()).max())
+    if deviation > tolerance:
+        temporary.unlink()
+        raise RuntimeError(
+            f"ONNX outputs of {model_name} deviate from PyTorch by {deviation}."
+        )
+    tokenizer.save_pretrained(str(directory))
+    model.config.save_pretrained(str(directory))
+    temporary.replace(filepath)
+    return directory
+
+
+def load_onnx_pipeline(model_name: str, task: str, precision: str) -> OnnxPipeline:
+    """Load an exported model into an ONNX Runtime session.
+
+    Parameters
+    ----------
+    model_name : str
+        Name or path of the pretrained model.
+    task : str
+        Either `ner` or `ned`.
+    precision : str
+        Either `fp32` or `int8`, the latter quantizes the weights of the
+        exported model dynamically.
+
+    Returns
+    -------
+    OnnxPipeline
+        The tokenizer and the session.
+    """
+    import transformers
+
+    directory = export_onnx_model(model_name, task)
+    filepath = Path(directory, "model.onnx")
+    if precision == "int8":
+        quantized = Path(directory, "model-int8.onnx")
+        if not quantized.exists():
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            logging.info("Quantizing ONNX model to INT8...")
+            temporary = quantized.with_suffix(".tmp")
+            quantize_dynamic(str(filepath), str(temporary), weight_type=QuantType.QInt8)
+            temporary.replace(quantized)
+        filepath = quantized
+    tokenizer = transformers.AutoTokenizer.from_pretrained(str(directory))
+    config = transformers.AutoConfig.from_pretrained(str(directory))
+    return OnnxPipeline(OnnxModel(filepath, config), tokenizer)
 
 
 class NamedEntityRecognition:
-    def __init__(self):
+    def __init__(self, precision: str = "fp32", backend: str = "torch"):
+        if precision not in PRECISIONS:
+            raise ValueError(f"The precision {precision} is not supported.")
+        if backend not in BACKENDS:
+            raise ValueError(f"The backend {backend} is not supported.")
+        self.precision = precision
+        self.backend = backend
         self._literary = MODEL_NAMES["ner"]["literary-texts"]
         self._press = MODEL_NAMES["ner"]["press-texts"]
 
@@ -32,26 +261,39 @@ class NamedEntityRecognition:
         if domain.lower() == "literary-texts":
             if not hasattr(self, "literary_pipeline"):
                 logging.info("Loading named entity recognition model...")
-                self.literary_pipeline = transformers.pipeline(
-                    "ner",
-                    model=self._literary,
-                    tokenizer=self._literary,
-                    ignore_labels=[],
-                )
+                with timer("model_loading"):
+                    self.literary_pipeline = self._load(self._literary)
             return self.literary_pipeline
         elif domain.lower() == "press-texts":
             if not hasattr(self, "press_pipeline"):
                 logging.info("Loading named entity recognition model...")
-                self.press_pipeline = transformers.pipeline(
-                    "ner", model=self._press, tokenizer=self._press, ignore_labels=[]
-                )
+                with timer("model_loading"):
+                    self.press_pipeline = self._load(self._press)
             return self.press_pipeline
         else:
             raise ValueError(f"The domain {domain} is not supported.")
 
+    def _load(self, model_name: str) -> Pipeline:
+        import transformers
+
+        if self.backend == "onnx":
+            return load_onnx_pipeline(model_name, "ner", self.precision)
+        model = model_name
+        if self.precision == "int8":
+            model = load_quantized_model(model_name, "ner")
+        return transformers.pipeline(
+            "ner", model=model, tokenizer=model_name, ignore_labels=[]
+        )
+
 
 class NamedEntityDisambiguation:
-    def __init__(self):
+    def __init__(self, precision: str = "fp32", backend: str = "torch"):
+        if precision not in PRECISIONS:
+            raise ValueError(f"The precision {precision} is not supported.")
+        if backend not in BACKENDS:
+            raise ValueError(f"The backend {backend} is not supported.")
+        self.precision = precision
+        self.backend = backend
         self._literary = MODEL_NAMES["ned"]["literary-texts"]
         self._press = MODEL_NAMES["ned"]["press-texts"]
 
@@ -59,16 +301,26 @@ class NamedEntityDisambiguation:
         if domain.lower() == "literary-texts":
             if not hasattr(self, "literary_pipeline"):
                 logging.info("Loading named entity disambiguation model...")
-                self.literary_pipeline = transformers.pipeline(
-                    "feature-extraction", model=self._literary, tokenizer=self._literary
-                )
+                with timer("model_loading"):
+                    self.literary_pipeline = self._load(self._literary)
             return self.literary_pipeline
         elif domain.lower() == "press-texts":
             if not hasattr(self, "press_pipeline"):
                 logging.info("Loading named entity disambiguation model...")
-                self.press_pipeline = transformers.pipeline(
-                    "feature-extraction", model=self._press, tokenizer=self._press
-                )
+                with timer("model_loading"):
+                    self.press_pipeline = self._load(self._press)
             return self.press_pipeline
         else:
             raise ValueError(f"The domain {domain} is not supported.")
+
+    def _load(self, model_name: str) -> Pipeline:
+        import transformers
+
+        if self.backend == "onnx":
+            return load_onnx_pipeline(model_name, "ned", self.precision)
+        model = model_name
+        if self.precision == "int8":
+            model = load_quantized_model(model_name, "ned")
+        return transformers.pipeline(
+            "feature-extraction", model=model, tokenizer=model_name
+        )
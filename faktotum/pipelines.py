@@ -5,114 +5,516 @@ faktotum.pipelines
 This module implements high-level data pipeline functions.
 """
 
+import gc
 import logging
+from typing import Generator, Iterable, List, Optional, TextIO, Union
 
 import numpy as np
-import pandas as pd
-import tqdm
-from strsimpy.jaro_winkler import JaroWinkler
 
 from faktotum.kb import KnowledgeBase
-from faktotum.models import NamedEntityDisambiguation, NamedEntityRecognition
-from faktotum.typing import Entities, Pipeline, TaggedTokens
+from faktotum.models import (
+    NamedEntityDisambiguation,
+    NamedEntityRecognition,
+    embeddings_key,
+)
+from faktotum.profiling import count, timed, timer
+from faktotum.typing import Pipeline, TaggedTokens
 from faktotum.utils import (
-    align_index,
-    cosine_similarity,
-    extract_features,
-    get_best_candidate,
-    group_mentions,
+    extract_batch_features,
+    find_candidates,
+    find_mentions,
+    get_best_candidates,
     pool_tokens,
     predict_labels,
     sentencize,
-    vectorize_context,
+    sentencize_stream,
 )
 
 NER_MODELS = NamedEntityRecognition()
 NED_MODELS = NamedEntityDisambiguation()
-JARO_WINKLER = JaroWinkler()
+DOMAINS = ("literary-texts", "press-texts")
+TASKS = ("ner", "ned")
+MODELS = {("ner", "fp32", "torch"): NER_MODELS, ("ned", "fp32", "torch"): NED_MODELS}
+
+
+def load_pipeline(
+    task: str, domain: str, precision: str = "fp32", backend: str = "torch"
+) -> Pipeline:
+    """Return the (cached) pipeline for a task and domain.
+
+    Parameters
+    ----------
+    task : str
+        Either `ner` or `ned`.
+    domain : str
+        Either `literary-texts` or `press-texts`.
+    precision : str
+        Either `fp32` for the original model or `int8` for a model with
+        dynamically quantized linear layers.
+    backend : str
+        Either `torch` or `onnx` to run an exported model with ONNX Runtime.
+
+    Returns
+    -------
+    Pipeline
+        The pipeline.
+    """
+    if task not in TASKS:
+        raise ValueError(f"The task {task} is not supported.")
+    key = (task, precision, backend)
+    if key not in MODELS:
+        models = NamedEntityRecognition if task == "ner" else NamedEntityDisambiguation
+        MODELS[key] = models(precision, backend)
+    return MODELS[key][domain]
 
 
-def nel(text: str, kb: KnowledgeBase, domain: str) -> TaggedTokens:
+def preload(
+    domains: Union[str, Iterable[str]] = DOMAINS,
+    tasks: Union[str, Iterable[str]] = TASKS,
+    precision: str = "fp32",
+    backend: str = "torch",
+):
+    """Load and warm up pipelines, e.g. before forking worker processes.
+
+    Every pipeline is loaded once and runs a dummy forward pass, so lazy
+    initialization does not slow down the first real request. Afterwards
+    the garbage collector is frozen: objects loaded so far are never
+    traversed again, which keeps the pages of forked children shared with
+    the parent copy-on-write instead of duplicating the models.
+
+    Parameters
+    ----------
+    domains : str or list
+        Domains to load, `literary-texts` and/or `press-texts`.
+    tasks : str or list
+        Tasks to load, `ner` and/or `ned`.
+    precision : str
+        Either `fp32` or `int8`.
+    backend : str
+        Either `torch` or `onnx`.
+    """
+    domains = [domains] if isinstance(domains, str) else list(domains)
+    tasks = [tasks] if isinstance(tasks, str) else list(tasks)
+    for task in tasks:
+        if task not in TASKS:
+            raise ValueError(f"The task {task} is not supported.")
+    for domain in domains:
+        for task in tasks:
+            pipeline = load_pipeline(task, domain, precision, backend)
+            if task == "ner":
+                predict_labels(pipeline, [["Warm-up", "."]])
+            else:
+                extract_batch_features(pipeline, [["Warm-up", "."]])
+            if backend == "torch":
+                pipeline.model.eval()
+                pipeline.model.requires_grad_(False)
+    gc.collect()
+    gc.freeze()
+
+
+@timed("nel")
+def nel(
+    text: Union[str, List[List[str]]],
+    kb: KnowledgeBase,
+    domain: str,
+    precision: str = "fp32",
+    backend: str = "torch",
+) -> TaggedTokens:
     """Named Entity Linking.
 
     Parameters
     ----------
-    text : str
-        The text to process.
+    text : str or list
+        The text to process, or its tokenized sentences as lists of words.
     kb : KnowledgeBase
         The knowledge base to link entities.
     domain : str
         Domain of the text, either `literary-texts` or `press-texts`.
+    precision : str
+        Numeric precision of the models, either `fp32` or `int8`.
+    backend : str
+        Either `torch` or `onnx`.
 
     Returns
     -------
     TaggedTokens
         The tagged tokens.
     """
-    tagged_tokens = ner(text, domain)
-    return ned(tagged_tokens, kb, domain)
+    tagged_tokens = ner(text, domain, precision=precision, backend=backend)
+    return ned(tagged_tokens, kb, domain, precision=precision, backend=backend)
 
 
-def ner(text: str, domain: str):
+def nel_stream(
+    source: Union[str, TextIO],
+    kb: KnowledgeBase,
+    domain: str,
+    chunk_size: int = 1000,
+    batch_size: int = 16,
+    precision: str = "fp32",
+    backend: str = "torch",
+) -> Generator[TaggedTokens, None, None]:
+    """Named Entity Linking for arbitrarily long texts.
+
+    Parameters
+    ----------
+    source : str or file
+        The text to process, or a text file opened for reading.
+    kb : KnowledgeBase
+        The knowledge base to link entities.
+    domain : str
+        Domain of the text, either `literary-texts` or `press-texts`.
+    chunk_size : int
+        Number of sentences per chunk.
+    batch_size : int
+        Number of sentences per forward pass.
+    precision : str
+        Numeric precision of the models, either `fp32` or `int8`.
+    backend : str
+        Either `torch` or `onnx`.
+
+    Yields
+    ------
+    TaggedTokens
+        The tagged tokens of one chunk, with sentence IDs counted from the
+        start of the text.
+    """
+    for tagged_tokens in ner_stream(
+        source, domain, chunk_size, batch_size, precision, backend
+    ):
+        yield ned(tagged_tokens, kb, domain, precision=precision, backend=backend)
+
+
+def ner(
+    text: Union[str, List[List[str]]],
+    domain: str,
+    batch_size: int = 16,
+    precision: str = "fp32",
+    backend: str = "torch",
+) -> TaggedTokens:
     """Named Entity Recognition.
 
     Parameters
     ----------
-    text : str
-        The text to process.
+    text : str or list
+        The text to process, or its tokenized sentences as lists of words.
+        Tokenized input is not segmented again, and the result has exactly
+        one row per word.
     domain : str
         Domain of the text, either `literary-texts` or `press-texts`.
+    batch_size : int
+        Number of sentences per forward pass.
+    precision : str
+        Numeric precision of the models, either `fp32` or `int8`.
+    backend : str
+        Either `torch` or `onnx`.
 
     Returns
     -------
     TaggedTokens
         The tagged tokens.
     """
-    pipeline = NER_MODELS[domain]
-    sentences = [(i, sentence) for i, sentence in enumerate(sentencize(text))]
-    predictions = list()
+    return ner_batch([text], domain, batch_size, precision, backend)[0]
+
+
+@timed("ner")
+def ner_batch(
+    texts: List[Union[str, List[List[str]]]],
+    domain: str,
+    batch_size: int = 16,
+    precision: str = "fp32",
+    backend: str = "torch",
+) -> List[TaggedTokens]:
+    """Named Entity Recognition for multiple texts.
+
+    Sentences of all texts are sorted by length and processed in padded
+    batches, so short documents share forward passes.
+
+    Parameters
+    ----------
+    texts : list
+        The texts to process, each either a string or a list of tokenized
+        sentences.
+    domain : str
+        Domain of the texts, either `literary-texts` or `press-texts`.
+    batch_size : int
+        Number of sentences per forward pass.
+    precision : str
+        Numeric precision of the models, either `fp32` or `int8`.
+    backend : str
+        Either `torch` or `onnx`.
+
+    Returns
+    -------
+    list
+        The tagged tokens, one data frame per text.
+    """
+    pipeline = load_pipeline("ner", domain, precision, backend)
+    with timer("segmentation"):
+        documents = [segment(text) for text in texts]
+    sentences = [sentence for document in documents for sentence in document]
+    count("sentences", len(sentences))
     logging.info("Processing sentences through NER pipeline...")
-    for i, sentence in sentences:
-        sentence = "".join(str(token) for token in sentence)
-        prediction = predict_labels(pipeline, sentence, i)
-        predictions.extend(prediction)
-    return pd.DataFrame(predictions).loc[:, ["sentence_id", "word", "entity"]]
+    words, entities = predict_labels(pipeline, sentences, batch_size)
+    frames = list()
+    start = 0
+    for document in documents:
+        end = start + len(document)
+        frames.append(_build_frame(words[start:end], entities[start:end]))
+        start = end
+    return frames
+
+
+def segment(text: Union[str, List[List[str]]]) -> List[List[str]]:
+    """Split a text into sentences of words, unless it is tokenized already."""
+    if isinstance(text, str):
+        return [[token.value for token in sentence] for sentence in sentencize(text)]
+    return [list(sentence) for sentence in text]
+
+
+def ner_stream(
+    source: Union[str, TextIO],
+    domain: str,
+    chunk_size: int = 1000,
+    batch_size: int = 16,
+    precision: str = "fp32",
+    backend: str = "torch",
+) -> Generator[TaggedTokens, None, None]:
+    """Named Entity Recognition for arbitrarily long texts.
+
+    The text is segmented incrementally and processed in chunks of
+    sentences, so memory does not grow with the length of the text.
+
+    Parameters
+    ----------
+    source : str or file
+        The text to process, or a text file opened for reading.
+    domain : str
+        Domain of the text, either `literary-texts` or `press-texts`.
+    chunk_size : int
+        Number of sentences per chunk.
+    batch_size : int
+        Number of sentences per forward pass.
+    precision : str
+        Numeric precision of the models, either `fp32` or `int8`.
+    backend : str
+        Either `torch` or `onnx`.
+
+    Yields
+    ------
+    TaggedTokens
+        The tagged tokens of one chunk, with sentence IDs counted from the
+        start of the text.
+    """
+    pipeline = load_pipeline("ner", domain, precision, backend)
+    first_sentence_id = 0
+    chunk = list()
+    for sentence in sentencize_stream(source):
+        chunk.append([token.value for token in sentence])
+        if len(chunk) == chunk_size:
+            yield _process_chunk(pipeline, chunk, batch_size, first_sentence_id)
+            first_sentence_id += len(chunk)
+            chunk = list()
+    if chunk:
+        yield _process_chunk(pipeline, chunk, batch_size, first_sentence_id)
+
+
+@timed("ner")
+def _process_chunk(
+    pipeline: Pipeline,
+    chunk: List[List[str]],
+    batch_size: int,
+    first_sentence_id: int,
+) -> TaggedTokens:
+    count("sentences", len(chunk))
+    words, entities = predict_labels(pipeline, chunk, batch_size)
+    return _build_frame(words, entities, first_sentence_id)
+
+
+def _build_frame(
+    words: List[np.ndarray], entities: List[np.ndarray], first_sentence_id: int = 0
+) -> TaggedTokens:
+    import pandas as pd
+
+    lengths = [len(sentence) for sentence in words]
+    sentence_ids = np.repeat(
+        np.arange(first_sentence_id, first_sentence_id + len(words)), lengths
+    )
+    return pd.DataFrame(
+        {
+            "sentence_id": sentence_ids,
+            "word": np.concatenate(words) if words else np.array([], dtype=object),
+            "entity": (
+                np.concatenate(entities) if entities else np.array([], dtype=object)
+            ),
+        },
+        columns=["sentence_id", "word", "entity"],
+    )
 
 
+@timed("ned")
 def ned(
     tokens: TaggedTokens,
     kb: KnowledgeBase,
     domain: str,
     candidate_threshold: float = 0.94,
+    precision: str = "fp32",
+    backend: str = "torch",
+    batch_size: int = 32,
+    max_tokens: Optional[int] = 8192,
 ):
     """Named Entity Disambiguation.
 
+    Mentions are found in one pass over the BIO tags of all tokens. Only
+    sentences containing mentions are encoded, in length-bucketed batches
+    together with the knowledge base contexts that still lack embeddings.
+
     Parameters
     ----------
-    text : str
+    tokens : TaggedTokens
         The tagged tokens.
+    kb : KnowledgeBase
+        The knowledge base to link entities.
     domain : str
         Domain of the text, either `literary-texts` or `press-texts`.
+    candidate_threshold : float
+        Minimum Jaro-Winkler similarity of a candidate surface form.
+    precision : str
+        Numeric precision of the models, either `fp32` or `int8`.
+    backend : str
+        Either `torch` or `onnx`.
+    batch_size : int
+        Maximum number of sequences per forward pass.
+    max_tokens : int, optional
+        Maximum number of (padded) tokens per forward pass. Sentences and
+        knowledge base contexts are grouped by length to fill it.
 
     Returns
     -------
     TaggedTokens
-        The tagged tokens.
+        The tagged tokens, with the linked entity identifiers (or `NIL`)
+        in the column `entity_id`.
     """
-    pipeline = NED_MODELS[domain]
-    identifiers = list()
+    pipeline = load_pipeline("ned", domain, precision, backend)
+    model_name = embeddings_key(domain, precision, backend)
+    if kb.model_name is not None and kb.model_name != model_name:
+        logging.warning(f"Discarding knowledge base embeddings of {kb.model_name}...")
+        kb.reset_embeddings()
+    kb.model_name = model_name
     logging.info("Processing sentences through NED pipeline...")
-    for sentence_id, sentence in tokens.groupby("sentence_id"):
-        entities = sentence.dropna()
-        index_mapping, features = extract_features(pipeline, sentence.loc[:, "word"])
-        for original_index, index, mention in group_mentions(entities):
-            aligned_index = align_index(index, index_mapping)
-            mention_embedding = pool_tokens(aligned_index, features)
-            best_candidate, score = get_best_candidate(
-                mention, mention_embedding, kb, candidate_threshold
-            )
-            identifiers.append((original_index, best_candidate))
-    tokens["entity_id"] = np.nan
-    for mention, candidate in identifiers:
-        tokens.iloc[mention, -1] = candidate
+    # work on tokens ordered by sentence, so every sentence is one block
+    order = np.argsort(tokens["sentence_id"].to_numpy(), kind="stable")
+    sentence_ids = tokens["sentence_id"].to_numpy()[order]
+    words = tokens["word"].to_numpy(dtype=object)[order]
+    mention_ids = find_mentions(
+        tokens["entity"].to_numpy(dtype=object)[order], sentence_ids
+    )
+    entity_ids = np.full(len(tokens), np.nan, dtype=object)
+    in_mention = np.flatnonzero(mention_ids >= 0)
+    if len(in_mention):
+        starts = np.flatnonzero(np.r_[True, sentence_ids[1:] != sentence_ids[:-1]])
+        ends = np.r_[starts[1:], len(order)]
+        sentence_of = np.repeat(np.arange(len(starts)), ends - starts)
+        positions = np.arange(len(order)) - starts[sentence_of]
+        boundaries = np.flatnonzero(np.diff(mention_ids[in_mention])) + 1
+        mentions = np.split(in_mention, boundaries)
+        count("mentions", len(mentions))
+        names = [" ".join(str(word) for word in words[m]) for m in mentions]
+        candidates = find_candidates(names, kb, candidate_threshold)
+        # knowledge base contexts without embeddings are encoded together
+        # with the sentences that contain mentions, sorted by length
+        missing = kb.missing(np.concatenate(candidates))
+        contexts, indices = kb.contexts(missing)
+        encoded = np.unique(sentence_of[in_mention])
+        sentences = [list(words[starts[i] : ends[i]]) for i in encoded]
+        features = extract_batch_features(
+            pipeline, sentences + contexts, batch_size, max_tokens
+        )
+        kb.add_embeddings(
+            missing,
+            [
+                pool_tokens(index, context)
+                for index, context in zip(indices, features[len(sentences) :])
+            ],
+        )
+        features = dict(zip(encoded, features[: len(sentences)]))
+        embeddings = [
+            pool_tokens(positions[m], features[sentence_of[m[0]]]) for m in mentions
+        ]
+        links = get_best_candidates(
+            names, embeddings, kb, pipeline, candidate_threshold, batch_size, candidates
+        )
+        links = np.array([candidate for candidate, _ in links], dtype=object)
+        entity_ids[order[in_mention]] = links[mention_ids[in_mention]]
+    tokens["entity_id"] = entity_ids
+    return tokens
+
+
+def ned_batch(
+    tokens: List[TaggedTokens],
+    kb: KnowledgeBase,
+    domain: str,
+    candidate_threshold: float = 0.94,
+    precision: str = "fp32",
+    backend: str = "torch",
+    batch_size: int = 32,
+    max_tokens: Optional[int] = 8192,
+) -> List[TaggedTokens]:
+    """Named Entity Disambiguation for multiple texts.
+
+    The tagged tokens of all texts are disambiguated together, so their
+    mentions share forward passes and candidate lookups.
+
+    Parameters
+    ----------
+    tokens : list
+        The tagged tokens, one data frame per text.
+    kb : KnowledgeBase
+        The knowledge base to link entities.
+    domain : str
+        Domain of the texts, either `literary-texts` or `press-texts`.
+    candidate_threshold : float
+        Minimum Jaro-Winkler similarity of a candidate surface form.
+    precision : str
+        Numeric precision of the models, either `fp32` or `int8`.
+    backend : str
+        Either `torch` or `onnx`.
+    batch_size : int
+        Maximum number of sequences per forward pass.
+    max_tokens : int, optional
+        Maximum number of (padded) tokens per forward pass.
+
+    Returns
+    -------
+    list
+        The tagged tokens with the column `entity_id`, one data frame per
+        text.
+    """
+    import pandas as pd
+
+    if not tokens:
+        return list()
+    # shift the sentence IDs, so sentences of different texts stay apart
+    shifted = list()
+    offset = 0
+    for frame in tokens:
+        sentence_ids = frame["sentence_id"].to_numpy()
+        if len(frame):
+            sentence_ids = sentence_ids - sentence_ids.min() + offset
+            offset = sentence_ids.max() + 1
+        shifted.append(frame.assign(sentence_id=sentence_ids))
+    linked = ned(
+        pd.concat(shifted, ignore_index=True),
+        kb,
+        domain,
+        candidate_threshold,
+        precision,
+        backend,
+        batch_size,
+        max_tokens,
+    )
+    entity_ids = np.split(
+        linked["entity_id"].to_numpy(), np.cumsum([len(frame) for frame in tokens])
+    )
+    for frame, entity_id in zip(tokens, entity_ids):
+        frame["entity_id"] = entity_id
     return tokens
@@ -0,0 +1,210 @@
+"""
+faktotum.profiling
+~~~~~~~~~~~~~~~~~~
+
+This module implements named timers and counters for the pipelines.
+"""
+
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Generator, Optional
+
+# callbacks receiving every measurement as (kind, name, value), where kind
+# is `timer` (value in seconds) or `counter`; replaced, never mutated, so
+# it can be read without a lock
+_CALLBACKS = tuple()
+# tracers receiving every span as (name, start, end, args)
+_TRACERS = tuple()
+_LOCK = threading.Lock()
+
+
+class Stats:
+    """Aggregated timers and counters of a profiled run.
+
+    Attributes
+    ----------
+    timers : dict
+        Total seconds spent in each stage. Stages nest, e.g. `forward` is
+        part of `ner`.
+    calls : dict
+        Number of times each stage was entered.
+    counters : dict
+        Totals of the counters, e.g. `sentences` or `candidates`.
+    """
+
+    def __init__(self):
+        self.timers = dict()
+        self.calls = dict()
+        self.counters = dict()
+        self._lock = threading.Lock()
+
+    def __call__(self, kind: str, name: str, value: float):
+        with self._lock:
+            if kind == "timer":
+                self.timers[name] = self.timers.get(name, 0.0) + value
+                self.calls[name] = self.calls.get(name, 0) + 1
+            else:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def __repr__(self):
+        return f"Stats(timers={self.timers}, counters={self.counters})"
+
+    def as_dict(self) -> Dict[str, Dict[str, float]]:
+        """Return timers, calls and counters as one dictionary."""
+        return {
+            "timers": dict(self.timers),
+            "calls": dict(self.calls),
+            "counters": dict(self.counters),
+        }
+
+    def summary(self) -> str:
+        """Format the timers, slowest first, and the counters as a table."""
+        lines = [f"{'stage':<20}{'seconds':>10}{'calls':>8}"]
+        for name, seconds in sorted(self.timers.items(), key=lambda item: -item[1]):
+            lines.append(f"{name:<20}{seconds:>10.3f}{self.calls[name]:>8}")
+        lines.append(f"{'counter':<20}{'total':>10}")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name:<20}{value:>10}")
+        return "\n".join(lines)
+
+
+def register(callback: Callable[[str, str, float], None]):
+    """Send every measurement to a callback, called as `callback(kind, name, value)`."""
+    global _CALLBACKS
+    with _LOCK:
+        _CALLBACKS = _CALLBACKS + (callback,)
+
+
+def unregister(callback: Callable[[str, str, float], None]):
+    """Stop sending measurements to a callback."""
+    global _CALLBACKS
+    with _LOCK:
+        callbacks = list(_CALLBACKS)
+        callbacks.remove(callback)
+        _CALLBACKS = tuple(callbacks)
+
+
+def register_tracer(tracer: Callable[[str, float, float, dict], None]):
+    """Send every span to a tracer, called as `tracer(name, start, end, args)`."""
+    global _TRACERS
+    with _LOCK:
+        _TRACERS = _TRACERS + (tracer,)
+
+
+def unregister_tracer(tracer: Callable[[str, float, float, dict], None]):
+    """Stop sending spans to a tracer."""
+    global _TRACERS
+    with _LOCK:
+        tracers = list(_TRACERS)
+        tracers.remove(tracer)
+        _TRACERS = tuple(tracers)
+
+
+def enabled() -> bool:
+    """Return True if measurements are recorded, to skip costly counting."""
+    return bool(_CALLBACKS)
+
+
+def count(name: str, value: int = 1):
+    """Add to a named counter."""
+    for callback in _CALLBACKS:
+        callback("counter", name, value)
+
+
+class _Timer:
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name: str, args: dict):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        end = time.perf_counter()
+        for callback in _CALLBACKS:
+            callback("timer", self.name, end - self.start)
+        for tracer in _TRACERS:
+            tracer(self.name, self.start, end, self.args)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name: str, **args):
+    """Measure the time spent in a `with` block under a name.
+
+    Keyword arguments are details passed on to tracers, e.g. the number of
+    sentences of a batch. Without registered callbacks and tracers, a
+    shared no-op context manager is returned, so instrumented code runs at
+    almost no extra cost.
+    """
+    return _Timer(name, args) if _CALLBACKS or _TRACERS else _NULL_TIMER
+
+
+def timed(name: str) -> Callable:
+    """Decorator measuring every call of a function, see `timer`."""
+
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _CALLBACKS and not _TRACERS:
+                return function(*args, **kwargs)
+            with _Timer(name, dict()):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def profile(
+    callback: Optional[Callable[[str, str, float], None]] = None,
+) -> Generator[Stats, None, None]:
+    """Record the timers and counters of all pipeline calls within a block.
+
+    Measurements of all threads are recorded, including the worker threads
+    of the asyncio API.
+
+    Parameters
+    ----------
+    callback : callable, optional
+        Additionally called with every measurement as
+        `callback(kind, name, value)`.
+
+    Yields
+    ------
+    Stats
+        The aggregated measurements, complete after the block.
+
+    Example
+    -------
+    >>> with faktotum.profile() as stats:
+    ...     faktotum.nel(text, kb, "press-texts")
+    >>> print(stats.summary())
+    """
+    stats = Stats()
+    register(stats)
+    if callback is not None:
+        register(callback)
+    try:
+        yield stats
+    finally:
+        unregister(stats)
+        if callback is not None:
+            unregister(callback)
@@ -8,16 +8,15 @@ def droc():
 
     for novel in e.test.values():
         for sentence in novel:
-            text = " ".join([token[0] for token in sentence])
-            result = faktotum.ner(text, domain="literary-texts")
+            words = [token[0] for token in sentence]
+            result = faktotum.ner([words], domain="literary-texts")
             result = result.fillna("O")
-            if len(result) == len(sentence):
-                for token, tag in zip(sentence, result["entity"]):
-                    if tag == "O":
-                        token[2] = "-"
-                    if tag != "O" and token[2] == "-":
-                        tag = "O"
-                    token[1] = tag
+            for token, tag in zip(sentence, result["entity"]):
+                if tag == "O":
+                    token[2] = "-"
+                if tag != "O" and token[2] == "-":
+                    tag = "O"
+                token[1] = tag
     e.similarities()
 
 
@@ -25,16 +24,15 @@ def smartdata():
     e = SMARTDATA("/mnt/data/users/simmler/kb")
 
     for sentence in e.test:
-        text = " ".join([token[0] for token in sentence])
-        result = faktotum.ner(text, domain="press-texts")
+        words = [token[0] for token in sentence]
+        result = faktotum.ner([words], domain="press-texts")
         result = result.fillna("O")
-        if len(result) == len(sentence):
-            for token, tag in zip(sentence, result["entity"]):
-                if tag == "O":
-                    token[2] = "-"
-                if tag != "O" and token[2] == "-":
-                    tag = "O"
-                token[1] = tag
+        for token, tag in zip(sentence, result["entity"]):
+            if tag == "O":
+                token[2] = "-"
+            if tag != "O" and token[2] == "-":
+                tag = "O"
+            token[1] = tag
     e.similarities()
 
 
@@ -17,11 +17,10 @@ from sklearn.cluster import AgglomerativeClustering
 from sklearn.metrics.pairwise import cosine_similarity
 import random
 import torch
+from faktotum import utils
 from faktotum.research.similarity import EntitySimilarityLearner, EntityEmbeddings
-from strsimpy.jaro_winkler import JaroWinkler
 
 EMBEDDING = BertEmbeddings("/mnt/data/users/simmler/model-zoo/ner-droc")
-JARO_WINKLER = JaroWinkler()
 
 
 class EntityLinker:
@@ -292,6 +291,15 @@ class EntityLinker:
             fps = list()
             prediction = list()
             kb = self._build_knowledge_base(novel)
+            # the surface forms are encoded once per novel and scored at once
+            entries = [
+                (person, context, mention)
+                for person, contexts in kb.items()
+                for context, mention in zip(contexts["CONTEXTS"], contexts["MENTIONS"])
+            ]
+            codes, lengths = utils.encode_strings(
+                [mention for _, _, mention in entries]
+            )
             for sentence in novel:
                 is_mentioned = [token for token in sentence if token[2] != "-"]
                 if not is_mentioned:
@@ -314,22 +322,17 @@ class EntityLinker:
                         best_mention = None
                         best_sent = None
                         TOP3 = dict()
-                        for person, contexts in kb.items():
-                            for context, candidate_vector, mention in zip(
-                                contexts["CONTEXTS"],
-                                contexts["EMBEDDINGS"],
-                                contexts["MENTIONS"],
-                            ):
-                                if context != sentence:
-                                    score = JARO_WINKLER.similarity(name, mention)
-                                    TOP3[
-                                        f"pred: {mention} ({person}) vs. gold: {name} ({identifier})"
-                                    ] = float(score)
-                                    if score > max_score:
-                                        max_score = score
-                                        best_candidate = person
-                                        best_mention = mention
-                                        best_sent = context
+                        scores = utils.jaro_winkler_similarities(name, codes, lengths)
+                        for (person, context, mention), score in zip(entries, scores):
+                            if context != sentence:
+                                TOP3[
+                                    f"pred: {mention} ({person}) vs. gold: {name} ({identifier})"
+                                ] = float(score)
+                                if score > max_score:
+                                    max_score = score
+                                    best_candidate = person
+                                    best_mention = mention
+                                    best_sent = context
 
                         prediction.append(
                             {
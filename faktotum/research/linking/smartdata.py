@@ -20,14 +20,11 @@ import difflib
 import random
 from faktotum import utils
 import statistics
-from strsimpy.jaro_winkler import JaroWinkler
 from faktotum import utils
 from faktotum.research.similarity import EntitySimilarityLearner, EntityEmbeddings
-from strsimpy.jaro_winkler import JaroWinkler
 
 random.seed(23)
 
-JARO_WINKLER = JaroWinkler()
 EMBEDDING = BertEmbeddings(
     "/mnt/data/users/simmler/model-zoo/entity-embeddings-smartdata"
 )
@@ -139,19 +136,17 @@ class EntityLinker:
                 max_score = 0.0
                 best_identifier = None
                 text = " ".join([token[0] for token in entity])
-                if "-PER" in entity[0][2]:
-                    kb = self.humans
-                else:
-                    kb = self.organizations
-                for key, value in kb.items():
-                    for mention in value["MENTIONS"]:
-                        score = self._string_similarity(mention, text)
-                        TOP3[
-                            f"pred: {mention} ({key}) vs. gold: {text} ({identifier})"
-                        ] = float(score)
-                        if score > max_score:
-                            max_score = score
-                            best_identifier = key
+                keys, mentions, codes, lengths = self._encode_mentions(
+                    "-PER" not in entity[0][2]
+                )
+                scores = utils.jaro_winkler_similarities(text, codes, lengths)
+                for key, mention, score in zip(keys, mentions, scores):
+                    TOP3[
+                        f"pred: {mention} ({key}) vs. gold: {text} ({identifier})"
+                    ] = float(score)
+                    if score > max_score:
+                        max_score = score
+                        best_identifier = key
                 prediction.append(
                     {
                         "pred": best_identifier,
@@ -239,9 +234,25 @@ class EntityLinker:
                     else:
                         yield (vector / len(mention)).reshape(1, -1)
 
-    @staticmethod
-    def _string_similarity(a, b):
-        return JARO_WINKLER.similarity(a, b)
+    def _encode_mentions(self, is_org, lower=False):
+        if not hasattr(self, "_encoded_mentions"):
+            self._encoded_mentions = dict()
+        if (is_org, lower) not in self._encoded_mentions:
+            kb = self.organizations if is_org else self.humans
+            keys = [key for key, value in kb.items() for _ in value["MENTIONS"]]
+            mentions = [
+                mention.lower() if lower else mention
+                for value in kb.values()
+                for mention in value["MENTIONS"]
+            ]
+            codes, lengths = utils.encode_strings(mentions)
+            self._encoded_mentions[(is_org, lower)] = (
+                np.array(keys, dtype=object),
+                mentions,
+                codes,
+                lengths,
+            )
+        return self._encoded_mentions[(is_org, lower)]
 
     def _get_candidates(self, mention, is_org):
         candidates = set()
@@ -253,10 +264,9 @@ class EntityLinker:
         for key, value in kb.items():
             if " " + mention + " " in " ".join(value["MENTIONS"]).lower():
                 candidates.add(key)
-            for context in value["MENTIONS"]:
-                score = self._string_similarity(mention, context.lower())
-                if score >= self.SIMILARITY_THRESHOLD:
-                    candidates.add(key)
+        keys, _, codes, lengths = self._encode_mentions(is_org, lower=True)
+        scores = utils.jaro_winkler_similarities(mention, codes, lengths)
+        candidates.update(keys[scores >= self.SIMILARITY_THRESHOLD])
         return list(candidates)
 
     def similarities(self, mask_entity=False):
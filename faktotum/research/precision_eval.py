@@ -0,0 +1,133 @@
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import faktotum
+
+DATA = Path(__file__).parent / "data"
+PRECISIONS = ("fp32", "int8")
+
+
+def load_sentences(filepath):
+    sentences = list()
+    sentence = list()
+    for line in Path(filepath).read_text(encoding="utf-8").splitlines():
+        if line.startswith("# "):
+            continue
+        if not line.strip():
+            if sentence:
+                sentences.append(sentence)
+            sentence = list()
+        else:
+            sentence.append(line.split())
+    if sentence:
+        sentences.append(sentence)
+    return sentences
+
+
+def get_spans(tags):
+    spans = set()
+    start = None
+    label = None
+    for i, tag in enumerate(list(tags) + ["O"]):
+        if start is not None and (not tag.startswith("I-") or tag[2:] != label):
+            spans.add((start, i, label))
+            start = None
+        if tag.startswith("B-") or (tag.startswith("I-") and start is None):
+            start = i
+            label = tag[2:]
+    return spans
+
+
+def f1(golds, preds):
+    tp = sum(len(gold & pred) for gold, pred in zip(golds, preds))
+    fp = sum(len(pred - gold) for gold, pred in zip(golds, preds))
+    fn = sum(len(gold - pred) for gold, pred in zip(golds, preds))
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    if precision + recall:
+        return round(2 * precision * recall / (precision + recall), 4)
+    return 0.0
+
+
+def ner(dataset, domain, precision):
+    sentences = load_sentences(Path(DATA, dataset, "test.txt"))
+    texts = [[[token[0] for token in sentence]] for sentence in sentences]
+    start = time.perf_counter()
+    results = faktotum.ner_batch(texts, domain, precision=precision)
+    seconds = time.perf_counter() - start
+    golds = list()
+    preds = list()
+    for sentence, result in zip(sentences, results):
+        golds.append(get_spans(token[1] for token in sentence))
+        preds.append(get_spans(result["entity"].fillna("O")))
+    return f1(golds, preds), len(golds), seconds
+
+
+def build_knowledge_base(sentences):
+    data = dict()
+    for sentence in sentences:
+        tags = [token[1] for token in sentence]
+        for start, end, _ in get_spans(tags):
+            # rows are `token tag ID POS`, with `-` for no entity
+            identifier = sentence[start][2]
+            if identifier not in {"-", "NIL"}:
+                knowledge = data.setdefault(
+                    identifier, {"CONTEXTS": list(), "ENTITY_INDICES": list()}
+                )
+                knowledge["CONTEXTS"].append([token[0] for token in sentence])
+                knowledge["ENTITY_INDICES"].append(list(range(start, end)))
+    return data
+
+
+def nel(precision):
+    train = load_sentences(Path(DATA, "smartdata", "linking", "train.txt"))
+    test = load_sentences(Path(DATA, "smartdata", "linking", "test.txt"))
+    kb = faktotum.KnowledgeBase(build_knowledge_base(train))
+    rows = list()
+    mentions = list()
+    for sentence_id, sentence in enumerate(test):
+        tags = [token[1] for token in sentence]
+        for start, _, _ in get_spans(tags):
+            identifier = sentence[start][2]
+            mentions.append(
+                (len(rows) + start, "NIL" if identifier == "-" else identifier)
+            )
+        for token in sentence:
+            entity = token[1] if token[1] != "O" else np.nan
+            rows.append(
+                {"sentence_id": sentence_id, "word": token[0], "entity": entity}
+            )
+    tokens = pd.DataFrame(rows, columns=["sentence_id", "word", "entity"])
+    start = time.perf_counter()
+    result = faktotum.ned(tokens, kb, "press-texts", precision=precision)
+    seconds = time.perf_counter() - start
+    correct = 0
+    for index, identifier in mentions:
+        predicted = result.iloc[index]["entity_id"]
+        if predicted == identifier:
+            correct += 1
+    return round(correct / len(mentions), 4), len(mentions), seconds
+
+
+def compare(task):
+    for precision in PRECISIONS:
+        if task == "droc":
+            score, n, seconds = ner("droc", "literary-texts", precision)
+            metric = "NER F1"
+        elif task == "smartdata":
+            score, n, seconds = ner("smartdata", "press-texts", precision)
+            metric = "NER F1"
+        else:
+            score, n, seconds = nel(precision)
+            metric = "Linking accuracy"
+        print(f"{task}\t{precision}\t{metric}: {score}\t(n={n}, {seconds:.1f}s)")
+
+
+if __name__ == "__main__":
+    tasks = sys.argv[1:] or ["droc", "smartdata", "linking"]
+    for task in tasks:
+        compare(task)
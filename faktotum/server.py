@@ -0,0 +1,287 @@
+"""
+faktotum.server
+~~~~~~~~~~~~~~~
+
+This module implements a local HTTP server with dynamic micro-batching.
+"""
+
+import asyncio
+import json
+import logging
+from typing import Any, List, Optional, Tuple
+
+from faktotum.aio import MicroBatcher, _check_text, _isolate_errors, get_executor
+from faktotum.kb import KnowledgeBase
+from faktotum.pipelines import ned_batch, ner_batch, preload
+from faktotum.typing import TaggedTokens
+
+MAX_BODY_SIZE = 64 * 1024 * 1024
+STATUS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+
+
+class Server:
+    """HTTP server for named entity recognition, disambiguation and linking.
+
+    The models and the knowledge base are loaded from disk once, and all
+    inference runs on a single background thread. Concurrent requests to an
+    endpoint are processed as micro-batches. The endpoints accept `POST`
+    requests with a JSON body:
+
+    * `/ner` with `{"text": ...}`, either a string or tokenized sentences.
+    * `/ned` with `{"tokens": [...]}`, records with `sentence_id`, `word`
+      and `entity`.
+    * `/nel` with `{"text": ...}`.
+
+    The response is a JSON array with one record per token.
+
+    Parameters
+    ----------
+    domain : str
+        Domain of the texts, either `literary-texts` or `press-texts`.
+    kb : KnowledgeBase, optional
+        The knowledge base to link entities. Without one, only `/ner` is
+        available.
+    max_batch_size : int
+        Maximum number of requests per micro-batch.
+    max_wait : float
+        Maximum number of seconds a request waits for others.
+    batch_size : int
+        Number of sentences per forward pass.
+    precision : str
+        Numeric precision of the models, either `fp32` or `int8`.
+    backend : str
+        Either `torch` or `onnx`.
+    """
+
+    def __init__(
+        self,
+        domain: str,
+        kb: Optional[KnowledgeBase] = None,
+        max_batch_size: int = 32,
+        max_wait: float = 0.01,
+        batch_size: int = 16,
+        precision: str = "fp32",
+        backend: str = "torch",
+    ):
+        self.domain = domain
+        self.kb = kb
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.options = {
+            "batch_size": batch_size,
+            "precision": precision,
+            "backend": backend,
+        }
+        self.batchers = dict()
+
+    def _ner(self, texts: List[Any]) -> List[TaggedTokens]:
+        return ner_batch(texts, self.domain, **self.options)
+
+    def _ned(self, frames: List[TaggedTokens]) -> List[TaggedTokens]:
+        return ned_batch(
+            frames,
+            self.kb,
+            self.domain,
+            precision=self.options["precision"],
+            backend=self.options["backend"],
+        )
+
+    def _nel(self, texts: List[Any]) -> List[TaggedTokens]:
+        return self._ned(self._ner(texts))
+
+    @staticmethod
+    def _parse(path: str, payload: Any) -> Any:
+        import pandas as pd
+
+        if not isinstance(payload, dict):
+            raise ValueError("The request body must be a JSON object.")
+        if path == "/ned":
+            tokens = payload.get("tokens")
+            if not isinstance(tokens, list) or not all(
+                isinstance(token, dict)
+                and {"sentence_id", "word", "entity"} <= set(token)
+                and isinstance(token["sentence_id"], int)
+                and isinstance(token["word"], str)
+                and isinstance(token["entity"], (str, type(None)))
+                for token in tokens
+            ):
+                raise ValueError(
+                    "The field 'tokens' must be a list of records with an "
+                    "integer 'sentence_id', a string 'word' and a string or "
+                    "null 'entity'."
+                )
+            return pd.DataFrame(tokens, columns=["sentence_id", "word", "entity"])
+        return _check_text(payload.get("text"))
+
+    async def handle(self, method: str, path: str, body: bytes) -> Tuple[int, str]:
+        """Answer one request.
+
+        Parameters
+        ----------
+        method : str
+            The HTTP method.
+        path : str
+            The requested path.
+        body : bytes
+            The request body.
+
+        Returns
+        -------
+        tuple
+            The status code and the JSON response body.
+        """
+        if path == "/health":
+            return 200, json.dumps({"status": "ok"})
+        if path not in self.batchers:
+            return 404, json.dumps({"error": f"Unknown endpoint {path}."})
+        if method != "POST":
+            return 405, json.dumps({"error": "Use POST."})
+        try:
+            payload = json.loads(body.decode("utf-8"))
+            key = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+            data = self._parse(path, payload)
+        except ValueError as error:
+            return 400, json.dumps({"error": str(error)})
+        try:
+            result = await self.batchers[path].submit(data, key)
+        except Exception as error:
+            logging.exception(f"Request to {path} failed.")
+            return 500, json.dumps({"error": str(error)})
+        return 200, result.to_json(orient="records", force_ascii=False)
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, version = request_line.decode("latin-1").split()
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY_SIZE:
+                    status, response = 413, json.dumps({"error": "Body too large."})
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    status, response = await self.handle(
+                        method, path.split("?")[0], body
+                    )
+                    connection = headers.get("connection", "").lower()
+                    keep_alive = (
+                        connection != "close"
+                        if version == "HTTP/1.1"
+                        else connection == "keep-alive"
+                    )
+                content = response.encode("utf-8")
+                writer.write(
+                    (
+                        f"{version} {status} {STATUS[status]}\r\n"
+                        "Content-Type: application/json; charset=utf-8\r\n"
+                        f"Content-Length: {len(content)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                        "\r\n"
+                    ).encode("latin-1")
+                    + content
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000):
+        """Serve requests until cancelled.
+
+        Parameters
+        ----------
+        host : str
+            The address to listen on.
+        port : int
+            The port to listen on.
+        """
+        endpoints = {"/ner": self._ner}
+        if self.kb is not None:
+            endpoints.update({"/ned": self._ned, "/nel": self._nel})
+        self.batchers = {
+            path: MicroBatcher(
+                _isolate_errors(function),
+                get_executor("inference"),
+                self.max_batch_size,
+                self.max_wait,
+            )
+            for path, function in endpoints.items()
+        }
+        tasks = [
+            asyncio.ensure_future(batcher.run()) for batcher in self.batchers.values()
+        ]
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        logging.info(f"Serving {', '.join(self.batchers)} on http://{host}:{port}...")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def serve(
+    domain: str,
+    kb: Optional[str] = None,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    max_batch_size: int = 32,
+    max_wait: float = 0.01,
+    batch_size: int = 16,
+    precision: str = "fp32",
+    backend: str = "torch",
+):
+    """Load the models and the knowledge base, and serve requests.
+
+    Parameters
+    ----------
+    domain : str
+        Domain of the texts, either `literary-texts` or `press-texts`.
+    kb : str, optional
+        Path to a knowledge base dump or binary directory. Without one,
+        only named entity recognition is served.
+    host : str
+        The address to listen on.
+    port : int
+        The port to listen on.
+    max_batch_size : int
+        Maximum number of requests per micro-batch.
+    max_wait : float
+        Maximum number of seconds a request waits for others.
+    batch_size : int
+        Number of sentences per forward pass.
+    precision : str
+        Numeric precision of the models, either `fp32` or `int8`.
+    backend : str
+        Either `torch` or `onnx`.
+    """
+    knowledge_base = KnowledgeBase.load(kb) if kb else None
+    preload(domain, ["ner", "ned"] if kb else ["ner"], precision, backend)
+    server = Server(
+        domain, knowledge_base, max_batch_size, max_wait, batch_size, precision, backend
+    )
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        logging.info("Shutting down...")
@@ -0,0 +1,218 @@
+"""
+faktotum.tracing
+~~~~~~~~~~~~~~~~
+
+This module implements the export of pipeline spans as Chrome trace events,
+which can be opened in Perfetto or chrome://tracing.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Generator, Iterable, Optional, Union
+
+from faktotum.profiling import register_tracer, unregister_tracer
+
+_WRITER = None
+
+
+class TraceWriter:
+    """Buffer spans of this process and write them in the background.
+
+    Spans are written as one trace event per line to a part file; `merge`
+    combines the parts of all processes into one trace.
+
+    Parameters
+    ----------
+    filepath : str or Path
+        The part file.
+    flush_interval : float
+        Seconds between two writes of the buffered spans.
+    """
+
+    def __init__(self, filepath: Union[str, Path], flush_interval: float = 0.5):
+        self.filepath = Path(filepath)
+        self.flush_interval = flush_interval
+        self.pid = os.getpid()
+        # perf_counter is precise, the wall clock aligns the processes
+        self.origin = time.time() - time.perf_counter()
+        self.threads = set()
+        self.events = [
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": self.pid,
+                "args": {"name": multiprocessing.current_process().name},
+            }
+        ]
+        self.lock = threading.Lock()
+        self.file = self.filepath.open("w", encoding="utf-8")
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name="faktotum-trace", daemon=True
+        )
+        self.thread.start()
+
+    def __call__(self, name: str, start: float, end: float, args: dict):
+        tid = threading.get_ident()
+        event = {
+            "name": name,
+            "cat": "faktotum",
+            "ph": "X",
+            "ts": round((self.origin + start) * 1e6, 1),
+            "dur": round((end - start) * 1e6, 1),
+            "pid": self.pid,
+            "tid": tid,
+        }
+        if args:
+            event["args"] = args
+        with self.lock:
+            if tid not in self.threads:
+                self.threads.add(tid)
+                self.events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": self.pid,
+                        "tid": tid,
+                        "args": {"name": threading.current_thread().name},
+                    }
+                )
+            self.events.append(event)
+
+    def _run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Write the buffered spans."""
+        with self.lock:
+            events, self.events = self.events, list()
+        if events and not self.file.closed:
+            self.file.write("".join(json.dumps(event) + "\n" for event in events))
+            self.file.flush()
+
+    def close(self):
+        """Write the remaining spans and close the part file."""
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+
+
+def _forget_after_fork():
+    # a forked child inherits the writer, but neither its thread nor the
+    # right to write to the parent's file
+    global _WRITER
+    if _WRITER is not None:
+        unregister_tracer(_WRITER)
+        _WRITER = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_after_fork)
+
+
+def part_path(filepath: Union[str, Path], pid: Optional[int] = None) -> Path:
+    """Return the part file of a process for a trace."""
+    filepath = Path(filepath)
+    return filepath.with_name(f"{filepath.name}.{pid or os.getpid()}.part")
+
+
+def start(filepath: Union[str, Path], flush_interval: float = 0.5) -> Path:
+    """Start tracing this process into a part file of the given trace.
+
+    Parameters
+    ----------
+    filepath : str or Path
+        The trace file.
+    flush_interval : float
+        Seconds between two writes of the buffered spans.
+
+    Returns
+    -------
+    Path
+        The part file of this process.
+    """
+    global _WRITER
+    stop()
+    _WRITER = TraceWriter(part_path(filepath), flush_interval)
+    register_tracer(_WRITER)
+    return _WRITER.filepath
+
+
+def stop():
+    """Stop tracing this process and write the remaining spans."""
+    global _WRITER
+    if _WRITER is not None:
+        unregister_tracer(_WRITER)
+        _WRITER.close()
+        _WRITER = None
+
+
+def merge(parts: Iterable[Union[str, Path]], filepath: Union[str, Path]) -> int:
+    """Combine part files into one trace in the JSON object format.
+
+    Incomplete last lines, e.g. of a killed process, are skipped.
+
+    Parameters
+    ----------
+    parts : list
+        The part files, removed afterwards.
+    filepath : str or Path
+        The trace file.
+
+    Returns
+    -------
+    int
+        The number of trace events.
+    """
+    events = list()
+    for part in parts:
+        part = Path(part)
+        for line in part.read_text(encoding="utf-8").splitlines():
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                logging.warning(f"Skipping an incomplete event in {part.name}.")
+        part.unlink()
+    events.sort(key=lambda event: event.get("ts", 0))
+    with Path(filepath).open("w", encoding="utf-8") as trace:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace)
+    return len(events)
+
+
+@contextmanager
+def trace(
+    filepath: Union[str, Path], flush_interval: float = 0.5
+) -> Generator[None, None, None]:
+    """Record the spans of all pipeline calls within a block.
+
+    The spans, e.g. of every sentence batch, model forward pass and
+    candidate search, are written as Chrome trace events with the process
+    and thread that ran them. Open the file in https://ui.perfetto.dev or
+    chrome://tracing.
+
+    Parameters
+    ----------
+    filepath : str or Path
+        The trace file.
+    flush_interval : float
+        Seconds between two writes of the buffered spans.
+
+    Example
+    -------
+    >>> with faktotum.trace("nel.json"):
+    ...     faktotum.nel(text, kb, "press-texts")
+    """
+    part = start(filepath, flush_interval)
+    try:
+        yield
+    finally:
+        stop()
+        merge([part], filepath)
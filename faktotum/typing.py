@@ -5,13 +5,20 @@ faktotum.typing
 This module implements type hints.
 """
 
-from typing import Dict, List, Union
+from typing import TYPE_CHECKING, Dict, List, Union
 
-import pandas as pd
-import transformers
+if TYPE_CHECKING:
+    import pandas as pd
+    import transformers
+
+    Pipeline = transformers.pipelines.Pipeline
+    TaggedTokens = pd.DataFrame
+else:
+    # forward references, so importing the type hints does not import
+    # pandas and transformers
+    Pipeline = "transformers.pipelines.Pipeline"
+    TaggedTokens = "pandas.DataFrame"
 
 Entities = List[Dict[str, Union[str, float]]]
-Pipeline = transformers.pipelines.Pipeline
 KnowledgeBase = Dict[str, Dict[str, Union[List[str], str]]]
-TaggedTokens = pd.DataFrame
 KnowledgeBaseDump = Dict[str, Union[List[List[str]], List[List[int]]]]
@@ -5,13 +5,16 @@ faktotum.utils
 This module implements general helper functions.
 """
 
-from typing import Generator, List
+import logging
+from typing import Dict, Generator, List, Optional, TextIO, Tuple, Union
 
 import numpy as np
 import syntok.segmenter
 import syntok.tokenizer
 
-from faktotum.typing import Entities, KnowledgeBase, Pipeline, TaggedTokens
+from faktotum.models import OnnxModel
+from faktotum.profiling import count, enabled, timed, timer
+from faktotum.typing import KnowledgeBase, Pipeline, TaggedTokens
 
 TOKENIZER = syntok.tokenizer.Tokenizer()
 
@@ -49,105 +52,854 @@ def sentencize(text: str) -> Generator[str, None, None]:
             yield sentence
 
 
-def pool_tokens(indices, features):
-    entity = features[indices[0]]
-    for index in indices[1:]:
-        entity += features[index]
-    return entity
-
-
-def extract_features(pipeline: Pipeline, sentence: List[str]) -> Entities:
-    vectors = list()
-    text = " ".join(sentence)
-    index = dict()
-    for i, token in enumerate(sentence):
-        subtokens = [
-            t for t in pipeline.tokenizer.tokenize(token) if not t.startswith("##")
+def sentencize_stream(
+    source: Union[str, TextIO], max_characters: int = 100000
+) -> Generator[str, None, None]:
+    """Split text into sentences, reading a file paragraph by paragraph.
+
+    Parameters
+    ----------
+    source
+        The text, or a text file opened for reading.
+    max_characters
+        Paragraphs longer than this are split at the next line break.
+
+    Yields
+    ------
+    One sentence at a time.
+    """
+    if isinstance(source, str):
+        yield from sentencize(source)
+        return
+    paragraph = list()
+    size = 0
+    for line in source:
+        if line.strip():
+            paragraph.append(line)
+            size += len(line)
+        if paragraph and (not line.strip() or size >= max_characters):
+            yield from sentencize("".join(paragraph))
+            paragraph = list()
+            size = 0
+    if paragraph:
+        yield from sentencize("".join(paragraph))
+
+
+def sort_by_length(sequences: List[List[int]]) -> List[int]:
+    """Return the indices of the sequences sorted by length, longest first."""
+    return sorted(range(len(sequences)), key=lambda i: len(sequences[i]), reverse=True)
+
+
+def batchify(indices: List[int], batch_size: int) -> Generator[List[int], None, None]:
+    """Split a list of indices into chunks of at most `batch_size` elements."""
+    for start in range(0, len(indices), batch_size):
+        yield indices[start : start + batch_size]
+
+
+def batchify_by_tokens(
+    sequences: List[List[int]], max_tokens: int, batch_size: Optional[int] = None
+) -> Generator[List[int], None, None]:
+    """Group sequences of similar length into batches within a token budget.
+
+    Sequences are sorted by length, so each batch holds sequences of about
+    the same length, and a batch is closed once its padded size would
+    exceed `max_tokens`. Longer sequences thus end up in smaller batches.
+
+    Parameters
+    ----------
+    sequences
+        The token ids of each sequence.
+    max_tokens
+        Maximum number of tokens per padded batch. A single sequence longer
+        than that forms a batch of its own.
+    batch_size
+        Optional maximum number of sequences per batch.
+
+    Yields
+    ------
+    The indices of the sequences of one batch.
+    """
+    batch = list()
+    for i in sort_by_length(sequences):
+        # sorted longest first, so the first sequence determines the padding
+        longest = len(sequences[batch[0]]) if batch else len(sequences[i])
+        full = batch_size is not None and len(batch) >= batch_size
+        if batch and (full or (len(batch) + 1) * longest > max_tokens):
+            yield batch
+            batch = list()
+        batch.append(i)
+    if batch:
+        yield batch
+
+
+def pad_batch(
+    sequences: List[List[int]], pad_token_id: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Pad token ids to the longest sequence in the batch.
+
+    Parameters
+    ----------
+    sequences
+        Token ids, one list per sequence.
+    pad_token_id
+        The id of the padding token.
+
+    Returns
+    -------
+    The padded input ids and the corresponding attention mask.
+    """
+    max_length = max(len(sequence) for sequence in sequences)
+    input_ids = np.full((len(sequences), max_length), pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(sequences), max_length), dtype=np.int64)
+    for i, sequence in enumerate(sequences):
+        input_ids[i, : len(sequence)] = sequence
+        attention_mask[i, : len(sequence)] = 1
+    return input_ids, attention_mask
+
+
+def forward(
+    pipeline: Pipeline, input_ids: np.ndarray, attention_mask: np.ndarray
+) -> np.ndarray:
+    """Run a padded batch through the model of a pipeline.
+
+    Parameters
+    ----------
+    pipeline
+        The pipeline holding the model.
+    input_ids
+        Padded token ids of shape (batch size, sequence length).
+    attention_mask
+        Attention mask of the same shape.
+
+    Returns
+    -------
+    The first output of the model, e.g. logits or hidden states, as one
+    array of shape (batch size, sequence length, dimensions). Outputs on the
+    CPU are returned as view of the tensor without copying.
+    """
+    if enabled():
+        count("forward_passes")
+        count("subwords", int(attention_mask.sum()))
+    with timer("forward", shape=input_ids.shape):
+        if isinstance(pipeline.model, OnnxModel):
+            return pipeline.model(input_ids, attention_mask)[0]
+
+        import torch
+
+        device = next(pipeline.model.parameters()).device
+        with torch.no_grad():
+            outputs = pipeline.model(
+                input_ids=torch.from_numpy(input_ids).to(device),
+                attention_mask=torch.from_numpy(attention_mask).to(device),
+            )
+        return outputs[0].cpu().numpy()
+
+
+def max_sequence_length(pipeline: Pipeline) -> int:
+    """Return the maximum number of tokens the model of a pipeline accepts."""
+    length = pipeline.model.config.max_position_embeddings
+    model_max_length = getattr(pipeline.tokenizer, "model_max_length", None)
+    # tokenizers without a limit report a huge sentinel value
+    if model_max_length and model_max_length < 1e6:
+        length = min(length, model_max_length)
+    return length
+
+
+def _most_central(
+    offsets: np.ndarray, size: int, first: np.ndarray, last: np.ndarray
+) -> np.ndarray:
+    # for every span of tokens, the window whose nearest edge is farthest
+    # from it
+    centrality = np.minimum(
+        first[None, :] - offsets[:, None], offsets[:, None] + size - 1 - last
+    )
+    return centrality.argmax(axis=0)
+
+
+def forward_windows(
+    pipeline: Pipeline,
+    sequences: List[List[int]],
+    word_ids: List[np.ndarray],
+    max_length: int,
+    stride: Optional[int] = None,
+    batch_size: int = 32,
+) -> List[np.ndarray]:
+    """Run sequences longer than the model limit as overlapping windows.
+
+    Each sequence is cut into windows of `max_length` tokens (including
+    special tokens), starting every `stride` tokens. The windows of all
+    sequences are processed in batches, and every word takes the outputs of
+    all its tokens from the window in which it is most central.
+
+    Parameters
+    ----------
+    pipeline
+        The pipeline holding the model.
+    sequences
+        The token ids of each sequence, including special tokens.
+    word_ids
+        For each sequence, the word index of every token, -1 for special
+        tokens.
+    max_length
+        Maximum number of tokens per window.
+    stride
+        Number of tokens between the starts of two windows, defaults to
+        half a window.
+    batch_size
+        Number of windows per forward pass.
+
+    Returns
+    -------
+    One output array per sequence, aligned with its tokens. Rows of special
+    tokens are zero.
+    """
+    tokenizer = pipeline.tokenizer
+    size = max_length - tokenizer.num_special_tokens_to_add()
+    stride = min(stride or max(size // 2, 1), size)
+    # positions of the content tokens, marked with -1, inside a window
+    inner = np.flatnonzero(
+        np.array(tokenizer.build_inputs_with_special_tokens([-1] * size)) == -1
+    )
+    windows = list()
+    starts = list()
+    for ids, words in zip(sequences, word_ids):
+        content = np.asarray(ids)[words >= 0]
+        last = max(len(content) - size, 0)
+        offsets = np.r_[np.arange(0, last, stride), last]
+        for start in offsets:
+            windows.append(
+                tokenizer.build_inputs_with_special_tokens(
+                    content[start : start + size].tolist()
+                )
+            )
+        starts.append(offsets)
+    outputs = [None] * len(windows)
+    for batch in batchify(sort_by_length(windows), batch_size):
+        with timer("batch", windows=len(batch)):
+            input_ids, attention_mask = pad_batch(
+                [windows[i] for i in batch], tokenizer.pad_token_id
+            )
+            states = forward(pipeline, input_ids, attention_mask)
+            for i, window in zip(batch, states):
+                outputs[i] = window
+    merged = list()
+    first = 0
+    for ids, words, offsets in zip(sequences, word_ids, starts):
+        positions = np.flatnonzero(words >= 0)
+        tokens = np.arange(len(positions))
+        # first and last token of the word of every token, so all subwords
+        # of a word are taken from the same window
+        word_of = words[positions]
+        _, starts, inverse = np.unique(word_of, return_index=True, return_inverse=True)
+        _, ends = np.unique(word_of[::-1], return_index=True)
+        starts = starts[inverse]
+        ends = len(tokens) - 1 - ends[inverse]
+        best = _most_central(offsets, size, starts, ends)
+        inside = (tokens >= offsets[best]) & (tokens < offsets[best] + size)
+        if not inside.all():
+            # words longer than a window take each subword from the window
+            # it is most central in
+            best = np.where(inside, best, _most_central(offsets, size, tokens, tokens))
+        stack = np.stack(
+            [outputs[first + i][inner[: len(positions)]] for i in range(len(offsets))]
+        )
+        result = np.zeros((len(ids),) + stack.shape[2:], dtype=stack.dtype)
+        result[positions] = stack[best, tokens - offsets[best]]
+        merged.append(result)
+        first += len(offsets)
+    return merged
+
+
+def forward_batches(
+    pipeline: Pipeline,
+    sequences: List[List[int]],
+    word_ids: List[np.ndarray],
+    batch_size: int = 32,
+    max_tokens: Optional[int] = None,
+    stride: Optional[int] = None,
+) -> Generator[Tuple[List[int], np.ndarray], None, None]:
+    """Run encoded sequences through the model of a pipeline in batches.
+
+    Sequences longer than the model limit are processed as overlapping
+    windows, see `forward_windows`, and yielded one at a time.
+
+    Parameters
+    ----------
+    pipeline
+        The pipeline holding the model.
+    sequences
+        The token ids of each sequence, including special tokens.
+    word_ids
+        For each sequence, the word index of every token, -1 for special
+        tokens.
+    batch_size
+        Maximum number of sequences per forward pass.
+    max_tokens
+        If set, sequences are grouped into length buckets with at most this
+        many (padded) tokens per forward pass.
+    stride
+        Number of tokens between the starts of two windows.
+
+    Yields
+    ------
+    The indices of the sequences in a batch and the model output for them.
+    """
+    max_length = max_sequence_length(pipeline)
+    short = [i for i, ids in enumerate(sequences) if len(ids) <= max_length]
+    subset = [sequences[i] for i in short]
+    if max_tokens:
+        batches = batchify_by_tokens(subset, max_tokens, batch_size)
+    else:
+        batches = batchify(sort_by_length(subset), batch_size)
+    for batch in batches:
+        batch = [short[i] for i in batch]
+        # the span covers the processing of the batch by the caller, too
+        with timer("batch", sequences=len(batch)):
+            input_ids, attention_mask = pad_batch(
+                [sequences[i] for i in batch], pipeline.tokenizer.pad_token_id
+            )
+            yield batch, forward(pipeline, input_ids, attention_mask)
+    long = [i for i, ids in enumerate(sequences) if len(ids) > max_length]
+    if long:
+        logging.info(f"Processing {len(long)} long sequences in windows...")
+        merged = forward_windows(
+            pipeline,
+            [sequences[i] for i in long],
+            [word_ids[i] for i in long],
+            max_length,
+            stride,
+            batch_size,
+        )
+        for i, states in zip(long, merged):
+            yield [i], states[None]
+
+
+def encode_words(
+    tokenizer, sentences: List[List[str]]
+) -> Tuple[List[List[int]], List[np.ndarray]]:
+    """Tokenize split sentences once, keeping the word of every subword.
+
+    Parameters
+    ----------
+    tokenizer
+        The tokenizer of a pipeline.
+    sentences
+        The tokenized sentences.
+
+    Returns
+    -------
+    The token ids of each sentence including special tokens, and for each
+    sentence an array with the word index of every token (-1 for special
+    tokens).
+    """
+    sentences = [[str(word) for word in sentence] for sentence in sentences]
+    if not sentences:
+        return list(), list()
+    if getattr(tokenizer, "is_fast", False):
+        encodings = tokenizer(sentences, is_split_into_words=True)
+        word_ids = [
+            np.array(
+                [-1 if word is None else word for word in encodings.word_ids(i)],
+                dtype=np.int64,
+            )
+            for i in range(len(sentences))
         ]
-        index[i] = subtokens
-    for token, vector in zip(
-        pipeline.tokenizer.tokenize(text), np.squeeze(pipeline(text))
+        return encodings["input_ids"], word_ids
+    encoded = list()
+    word_ids = list()
+    for sentence in sentences:
+        pieces = list()
+        words = list()
+        for i, word in enumerate(sentence):
+            subwords = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(word))
+            pieces.extend(subwords)
+            words.extend([i] * len(subwords))
+        special = np.array(tokenizer.get_special_tokens_mask(pieces), dtype=bool)
+        ids = np.full(len(special), -1, dtype=np.int64)
+        ids[~special] = words
+        encoded.append(tokenizer.build_inputs_with_special_tokens(pieces))
+        word_ids.append(ids)
+    return encoded, word_ids
+
+
+def pool_words(
+    states: np.ndarray, word_ids: List[np.ndarray], n_words: int
+) -> np.ndarray:
+    """Sum the subword vectors of each word for a padded batch.
+
+    Parameters
+    ----------
+    states
+        The model output of shape (batch size, sequence length, dimensions).
+    word_ids
+        For each sequence, the word index of every token, -1 for special
+        tokens.
+    n_words
+        The maximum number of words per sequence.
+
+    Returns
+    -------
+    Array of shape (batch size, words, dimensions); words without subwords
+    and padding get zero vectors.
+    """
+    weights = np.zeros((len(word_ids), n_words, states.shape[1]), dtype=states.dtype)
+    for i, ids in enumerate(word_ids):
+        tokens = np.flatnonzero(ids >= 0)
+        weights[i, ids[tokens], tokens] = 1
+    return np.matmul(weights, states)
+
+
+def pool_tokens(indices, features):
+    return np.sum([features[index] for index in indices], axis=0)
+
+
+def extract_features(pipeline: Pipeline, sentence: List[str]) -> np.ndarray:
+    return extract_batch_features(pipeline, [sentence])[0]
+
+
+@timed("extract_features")
+def extract_batch_features(
+    pipeline: Pipeline,
+    sentences: List[List[str]],
+    batch_size: int = 32,
+    max_tokens: Optional[int] = None,
+    stride: Optional[int] = None,
+) -> List[np.ndarray]:
+    """Extract contextualized word features for tokenized sentences.
+
+    Every sentence is tokenized once, and the subword vectors of each word
+    are summed using the word index of the tokens. Sentences longer than
+    the model limit are encoded in overlapping windows.
+
+    Parameters
+    ----------
+    pipeline
+        The feature extraction pipeline.
+    sentences
+        The tokenized sentences to process.
+    batch_size
+        Maximum number of sentences per forward pass.
+    max_tokens
+        If set, sentences are grouped into length buckets with at most this
+        many (padded) tokens per forward pass.
+    stride
+        Number of tokens between the starts of two windows over a long
+        sentence, defaults to half the model limit.
+
+    Returns
+    -------
+    One matrix with a row per word for each sentence, in the original
+    order. The matrices are views into one pooled array per batch.
+    """
+    with timer("tokenization"):
+        encoded, word_ids = encode_words(pipeline.tokenizer, sentences)
+    features = [None] * len(sentences)
+    for batch, hidden_states in forward_batches(
+        pipeline, encoded, word_ids, batch_size, max_tokens, stride
     ):
-        if token not in {"[CLS]", "[SEP]", "[MASK]"} and not token.startswith("##"):
-            vectors.append(vector)
-    return index, vectors
-
-
-def align_index(original_indices, subtoken_indices):
-    aligned_indices = list()
-    for i in original_indices:
-        for j, subtokens in enumerate(subtoken_indices[i]):
-            aligned_indices.append(i + j)
-    return aligned_indices
-
-
-def predict_labels(pipeline: Pipeline, sentence: str, sentence_id: int) -> Entities:
-    entities = list()
-    for token in pipeline(sentence):
-        if token["word"] not in {"[CLS]", "[SEP]", "[MASK]"}:
-            token["sentence_id"] = sentence_id
-            if token["word"].startswith("##"):
-                entities[-1]["word"] += token["word"][2:]
-            else:
-                del token["score"]
-                if token["entity"] == "O":
-                    token["entity"] = np.nan
-                entities.append(token)
-    return entities
-
-
-def get_best_candidate(mention, mention_embedding, kb, candidate_threshold):
-    best_candidate = "NIL"
-    best_score = 0.0
-    logging.info("Searching in knowledge base for candidates...")
-    for identifier, values in tqdm.tqdm(kb.data.items()):
-        for i, (index, context, candidate_embedding) in enumerate(
-            zip(values["ENTITY_INDICES"], values["CONTEXTS"], values["EMBEDDINGS"])
-        ):
-            candidate = " ".join(context[i] for i in index)
-            if (
-                JARO_WINKLER.similarity(mention.lower(), candidate.lower())
-                >= candidate_threshold
-            ):
-                if candidate_embedding is None:
-                    candidate_embedding = vectorize_context(kb.pipeline, context, index)
-                    values["EMBEDDINGS"][i] = candidate_embedding
-                score = cosine_similarity(mention_embedding, candidate_embedding)
-                if score > best_score:
-                    best_score = score
-                    best_candidate = identifier
-    return best_candidate, best_score
+        with timer("pooling"):
+            words = pool_words(
+                hidden_states,
+                [word_ids[i] for i in batch],
+                max(len(sentences[i]) for i in batch),
+            )
+        for i, vectors in zip(batch, words):
+            features[i] = vectors[: len(sentences[i])]
+    return features
+
+
+def predict_labels(
+    pipeline: Pipeline,
+    sentences: List[List[str]],
+    batch_size: int = 16,
+    stride: Optional[int] = None,
+) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    """Predict entity labels for a list of sentences in padded batches.
+
+    Labels are decoded in bulk from the logits of a batch; each word gets
+    the label of its first subword. Sentences longer than the model limit
+    are processed in overlapping windows.
+
+    Parameters
+    ----------
+    pipeline
+        The named entity recognition pipeline.
+    sentences
+        The sentences to process as lists of words. The result has exactly
+        one label per given word.
+    batch_size
+        Number of sentences per forward pass.
+    stride
+        Number of tokens between the starts of two windows over a long
+        sentence, defaults to half the model limit.
+
+    Returns
+    -------
+    The words and their entity labels (NaN for `O`) as object arrays, one
+    per sentence, in the original order.
+    """
+    tokenizer = pipeline.tokenizer
+    id2label = pipeline.model.config.id2label
+    labels = np.array([id2label[i] for i in range(len(id2label))], dtype=object)
+    labels[labels == "O"] = np.nan
+    with timer("tokenization"):
+        encoded, word_ids = encode_words(tokenizer, sentences)
+    words = [None] * len(sentences)
+    entities = [None] * len(sentences)
+    for batch, logits in forward_batches(
+        pipeline, encoded, word_ids, batch_size, stride=stride
+    ):
+        with timer("decoding"):
+            for i, token_label_ids in zip(batch, logits.argmax(axis=-1)):
+                ids = word_ids[i]
+                first = np.flatnonzero((ids >= 0) & (ids != np.r_[-1, ids[:-1]]))
+                words[i] = np.empty(len(sentences[i]), dtype=object)
+                words[i][:] = [str(word) for word in sentences[i]]
+                entities[i] = np.full(len(sentences[i]), np.nan, dtype=object)
+                entities[i][ids[first]] = labels[token_label_ids[first]]
+    return words, entities
+
+
+def get_best_candidate(mention, mention_embedding, kb, pipeline, candidate_threshold):
+    return get_best_candidates(
+        [mention], [mention_embedding], kb, pipeline, candidate_threshold
+    )[0]
+
+
+def find_candidates(
+    mentions: List[str], kb, candidate_threshold: float
+) -> List[np.ndarray]:
+    """Look up the knowledge base rows whose surface form resembles a mention.
+
+    Parameters
+    ----------
+    mentions
+        The mentions to look up.
+    kb
+        The knowledge base.
+    candidate_threshold
+        Minimum Jaro-Winkler similarity of a candidate surface form.
+
+    Returns
+    -------
+    The sorted candidate rows of each mention.
+    """
+    if kb.surface_index is None:
+        with timer("surface_index"):
+            kb.build_surface_index()
+    with timer("candidate_search", mentions=len(mentions)):
+        candidates = [kb.surface_index.search(m, candidate_threshold) for m in mentions]
+    count("candidates", sum(len(rows) for rows in candidates))
+    return candidates
+
+
+def get_best_candidates(
+    mentions: List[str],
+    mention_embeddings: np.ndarray,
+    kb,
+    pipeline: Pipeline,
+    candidate_threshold: float,
+    batch_size: int = 32,
+    candidates: Optional[List[np.ndarray]] = None,
+) -> List[Tuple[str, float]]:
+    """Link mentions to the most similar knowledge base entities.
+
+    Candidates are the contexts whose surface form reaches the Jaro-Winkler
+    threshold. All mentions are scored against the union of their candidate
+    rows in one matrix product, and each mention is linked to the entity
+    with the highest cosine similarity among its own candidates. With a
+    vector index, mentions with more candidates than the index scans are
+    looked up in the index instead, falling back to the exact scores if
+    none of their candidates is among the neighbours.
+
+    Parameters
+    ----------
+    mentions
+        The mentions to link.
+    mention_embeddings
+        The embedding of each mention.
+    kb
+        The knowledge base.
+    pipeline
+        The feature extraction pipeline, used for contexts that are not
+        vectorized yet.
+    candidate_threshold
+        Minimum Jaro-Winkler similarity of a candidate surface form.
+    batch_size
+        Number of contexts per forward pass.
+    candidates
+        The candidate rows of each mention, if already looked up with
+        `find_candidates`.
+
+    Returns
+    -------
+    The best entity identifier (or `NIL`) and its score for each mention.
+    """
+    nil = ("NIL", 0.0)
+    if not len(mentions):
+        return list()
+    mention_embeddings = normalize(np.stack(mention_embeddings))
+    if candidates is None:
+        candidates = find_candidates(mentions, kb, candidate_threshold)
+    links = [None] * len(mentions)
+    if kb.index is not None:
+        with timer("scoring"):
+            for i, rows in enumerate(candidates):
+                # the index only pays off for candidate sets larger than the
+                # rows it scans
+                if len(rows) > kb.index.scan_size:
+                    links[i] = _search_index(kb, mention_embeddings[i], rows)
+
+    # all other mentions, and those whose candidates the index missed, are
+    # scored exactly
+    exact = [i for i, link in enumerate(links) if link is None]
+    union = np.unique(np.concatenate([candidates[i] for i in exact] or [[]]))
+    union = union.astype(np.int64)
+    if not len(union):
+        return [nil if link is None else link for link in links]
+    kb.vectorize(union, pipeline, batch_size)
+    with timer("scoring"):
+        scored = _score_candidates(
+            kb, mention_embeddings[exact], [candidates[i] for i in exact], union
+        )
+    for i, link in zip(exact, scored):
+        links[i] = link
+    return links
+
+
+def _search_index(kb, mention_embedding, rows):
+    neighbours, scores = kb.index.search(mention_embedding)
+    matches = np.isin(neighbours, rows)
+    best = np.argmax(matches)
+    if matches[best] and scores[best] > 0:
+        return kb.identifiers[neighbours[best]], float(scores[best])
+    return None
+
+
+def _score_candidates(kb, mention_embeddings, candidates, union):
+    scores = mention_embeddings @ np.asarray(kb.embeddings[union]).T
+    allowed = np.zeros(scores.shape, dtype=bool)
+    for i, rows in enumerate(candidates):
+        allowed[i, np.searchsorted(union, rows)] = True
+    scores = np.where(allowed, scores, -np.inf)
+    # rows of the same entity are adjacent, so the maximum per entity is a
+    # reduction over contiguous column blocks
+    entities = kb.identifiers[union]
+    starts = np.flatnonzero(np.r_[True, entities[1:] != entities[:-1]])
+    entity_scores = np.maximum.reduceat(scores, starts, axis=1)
+    best = entity_scores.argmax(axis=1)
+    links = list()
+    for i, j in enumerate(best):
+        score = entity_scores[i, j]
+        if score > 0:
+            links.append((entities[starts[j]], float(score)))
+        else:
+            links.append(("NIL", 0.0))
+    return links
 
 
 def vectorize_context(pipeline, context, index):
-    index_mapping, features = extract_features(pipeline, context)
-    aligned_indices = align_index(index, index_mapping)
-    return pool_tokens(aligned_indices, features)
+    return vectorize_contexts(pipeline, [context], [index])[0]
+
+
+def vectorize_contexts(
+    pipeline: Pipeline,
+    contexts: List[List[str]],
+    indices: List[List[int]],
+    batch_size: int = 32,
+    max_tokens: Optional[int] = None,
+) -> List[np.ndarray]:
+    """Pool the entity embeddings of knowledge base contexts in batches.
+
+    Parameters
+    ----------
+    pipeline
+        The feature extraction pipeline.
+    contexts
+        The tokenized contexts.
+    indices
+        The entity indices, one list per context.
+    batch_size
+        Maximum number of contexts per forward pass.
+    max_tokens
+        Optional maximum number of tokens per forward pass.
+
+    Returns
+    -------
+    One pooled entity vector per context.
+    """
+    features = extract_batch_features(pipeline, contexts, batch_size, max_tokens)
+    return [pool_tokens(index, words) for index, words in zip(indices, features)]
+
+
+def encode_strings(strings: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Encode strings as zero-padded code point arrays.
+
+    Parameters
+    ----------
+    strings
+        The strings to encode.
+
+    Returns
+    -------
+    The code points of shape (number of strings, longest string) and the
+    length of each string.
+    """
+    array = np.array(strings, dtype=str).reshape(-1)
+    lengths = np.char.str_len(array).astype(np.int64)
+    width = max(array.dtype.itemsize // 4, 1)
+    codes = np.ascontiguousarray(array.astype(f"<U{width}")).view(np.uint32)
+    return codes.reshape(len(array), width), lengths
+
+
+def jaro_winkler_similarities(
+    mention: str,
+    candidates: Union[List[str], np.ndarray],
+    lengths: Optional[np.ndarray] = None,
+    chunk_size: int = 16384,
+) -> np.ndarray:
+    """Jaro-Winkler similarities between a mention and many candidates.
+
+    This mirrors :class:`strsimpy.jaro_winkler.JaroWinkler`, but scores all
+    candidates at once on their code point arrays.
+
+    Parameters
+    ----------
+    mention
+        The mention to compare.
+    candidates
+        The candidate strings, or code points as returned by
+        :func:`encode_strings`.
+    lengths
+        The candidate lengths, if the candidates are already encoded.
+    chunk_size
+        Number of candidates scored at once.
+
+    Returns
+    -------
+    The similarity for each candidate.
+    """
+    if lengths is None:
+        candidates, lengths = encode_strings(candidates)
+    query, _ = encode_strings([mention])
+    query = query[0, : len(mention)].astype(np.int64)
+    scores = np.empty(len(lengths), dtype=np.float64)
+    # candidates of the same length share matching windows and are scored together
+    order = np.argsort(lengths, kind="stable")
+    boundaries = np.flatnonzero(np.diff(lengths[order])) + 1
+    for group in np.split(order, boundaries):
+        if not len(group):
+            continue
+        length = int(lengths[group[0]])
+        for start in range(0, len(group), chunk_size):
+            chunk = group[start : start + chunk_size]
+            scores[chunk] = _jaro_winkler(
+                query, candidates[chunk, :length].astype(np.int64)
+            )
+    return scores
+
+
+def _jaro_winkler(query: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+    n, length = candidates.shape
+    if len(query) == length == 0:
+        return np.ones(n)
+    rows = np.arange(n)
+    # like strsimpy, the characters of the shorter string are searched in the
+    # longer one, and the candidate counts as longer if both have the same length
+    if len(query) > length:
+        shorter = candidates
+        longer = np.broadcast_to(query, (n, len(query)))
+    else:
+        shorter = np.broadcast_to(query, (n, len(query)))
+        longer = candidates
+    window = max(longer.shape[1] // 2 - 1, 0)
+
+    columns = np.full(shorter.shape, -1, dtype=np.int64)
+    flags = np.zeros(longer.shape, dtype=bool)
+    for i in range(shorter.shape[1]):
+        lower = max(i - window, 0)
+        upper = min(i + window + 1, longer.shape[1])
+        eligible = (longer[:, lower:upper] == shorter[:, i, None]) & ~flags[
+            :, lower:upper
+        ]
+        first = eligible.argmax(axis=1)
+        found = eligible[rows, first]
+        columns[found, i] = first[found] + lower
+        flags[found, first[found] + lower] = True
+
+    matched = columns >= 0
+    matches = matched.sum(axis=1)
+    # the matched characters in the order of the shorter and the longer string
+    sentinel = longer.shape[1]
+    positions = np.arange(shorter.shape[1])
+    in_order = np.sort(
+        np.where(matched, positions * (sentinel + 1) + columns, np.iinfo(np.int64).max),
+        axis=1,
+    )
+    in_order = np.where(
+        in_order == np.iinfo(np.int64).max, 0, in_order % (sentinel + 1)
+    )
+    sorted_columns = np.sort(np.where(matched, columns, sentinel), axis=1)
+    sorted_columns = np.minimum(sorted_columns, sentinel - 1)
+    differs = np.take_along_axis(longer, in_order, axis=1) != np.take_along_axis(
+        longer, sorted_columns, axis=1
+    )
+    transpositions = (differs & (positions < matches[:, None])).sum(axis=1) // 2
+
+    common = min(len(query), length)
+    equal = candidates[:, :common] == query[:common]
+    prefix = np.cumprod(equal, axis=1).sum(axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        jaro = (
+            matches / len(query)
+            + matches / length
+            + (matches - transpositions) / matches
+        ) / 3
+        boost = min(0.1, 1.0 / longer.shape[1]) * prefix * (1 - jaro)
+    scores = np.where(jaro > 0.7, jaro + boost, jaro)
+    scores = np.where(matches == 0, 0.0, scores)
+    if len(query) == length:
+        scores[prefix == length] = 1.0
+    return scores
 
 
 def cosine_similarity(x, y):
     return np.dot(x, y) / (np.linalg.norm(x) * np.linalg.norm(y))
 
 
-def group_mentions(entities):
-    mention = list()
-    indices = list()
-    original_indices = list()
-    tokens = entities.reset_index().iterrows()
-    for i, (j, token) in zip(entities.index, tokens):
-        if token["entity"].startswith("B"):
-            if mention:
-                yield original_indices, indices, " ".join(mention)
-                mention = list()
-                indices = list()
-                original_indices = list()
-            indices.append(j)
-            original_indices.append(i)
-            mention.append(token["word"])
-        elif token["entity"].startswith("I"):
-            if indices[-1] == j - 1:
-                indices.append(j)
-                original_indices.append(i)
-                mention.append(token["word"])
-    if mention:
-        yield original_indices, indices, " ".join(mention)
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Scale vectors to unit length, leaving zero vectors untouched."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def find_mentions(tags: np.ndarray, sentence_ids: np.ndarray) -> np.ndarray:
+    """Find the mention spans in a column of BIO tags.
+
+    A mention starts with a `B-` tag, or with an `I-` tag that does not
+    follow another entity token of the same sentence, and continues over
+    the directly following `I-` tags.
+
+    Parameters
+    ----------
+    tags
+        The entity tag of every token, NaN for none.
+    sentence_ids
+        The sentence of every token; tokens of a sentence are contiguous.
+
+    Returns
+    -------
+    The mention number of every token, -1 for tokens outside of mentions.
+    """
+    tags = np.array([tag if isinstance(tag, str) else "" for tag in tags], dtype=str)
+    sentence_ids = np.asarray(sentence_ids)
+    begins = np.char.startswith(tags, "B")
+    insides = np.char.startswith(tags, "I")
+    entities = begins | insides
+    continues = np.zeros(len(tags), dtype=bool)
+    continues[1:] = entities[:-1] & (sentence_ids[1:] == sentence_ids[:-1])
+    starts = begins | (insides & ~continues)
+    return np.where(entities, np.cumsum(starts) - 1, -1)
@@ -0,0 +1,47 @@
+import subprocess
+import sys
+
+# seconds `import faktotum` may take, generous for slow CI machines
+IMPORT_BUDGET = 1.0
+HEAVY_MODULES = ("torch", "transformers", "pandas")
+# accessing these imports the modules behind them, which must not load the
+# heavy modules either
+ATTRIBUTES = ("ner", "nel", "KnowledgeBase", "profile")
+
+SCRIPT = """
+import sys
+import time
+
+start = time.perf_counter()
+import faktotum
+
+for attribute in {attributes!r}:
+    getattr(faktotum, attribute)
+print(time.perf_counter() - start)
+print(" ".join(module for module in {modules!r} if module in sys.modules))
+"""
+
+
+def _import_faktotum():
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            SCRIPT.format(attributes=ATTRIBUTES, modules=HEAVY_MODULES),
+        ],
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout.splitlines()
+    return float(output[0]), output[1].split() if len(output) > 1 else list()
+
+
+def test_heavy_modules_not_imported():
+    _, modules = _import_faktotum()
+    assert modules == list()
+
+
+def test_import_time_within_budget():
+    # the fastest of a few runs, to be robust against a busy machine
+    seconds = min(_import_faktotum()[0] for _ in range(3))
+    assert seconds < IMPORT_BUDGET
@@ -0,0 +1,55 @@
+import random
+
+import numpy as np
+from strsimpy.jaro_winkler import JaroWinkler
+
+from faktotum.utils import encode_strings, jaro_winkler_similarities
+
+ALPHABET = "abcde ÄÖÜäöüß–é日本"
+JARO_WINKLER = JaroWinkler()
+
+
+def _random_strings(rng, n, max_length):
+    return [
+        "".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, max_length)))
+        for _ in range(n)
+    ]
+
+
+def _assert_matches_strsimpy(mention, candidates):
+    expected = [JARO_WINKLER.similarity(mention, candidate) for candidate in candidates]
+    np.testing.assert_allclose(
+        jaro_winkler_similarities(mention, candidates), expected, atol=1e-12
+    )
+    # pre-encoded candidates give the same scores
+    codes, lengths = encode_strings(candidates)
+    np.testing.assert_allclose(
+        jaro_winkler_similarities(mention, codes, lengths), expected, atol=1e-12
+    )
+
+
+def test_random_strings():
+    rng = random.Random(23)
+    candidates = _random_strings(rng, 300, 12)
+    for mention in _random_strings(rng, 30, 12):
+        _assert_matches_strsimpy(mention, candidates)
+
+
+def test_equal_length_strings():
+    rng = random.Random(42)
+    for length in range(1, 10):
+        candidates = [
+            "".join(rng.choice(ALPHABET) for _ in range(length)) for _ in range(50)
+        ]
+        _assert_matches_strsimpy(candidates[0], candidates)
+
+
+def test_empty_strings():
+    _assert_matches_strsimpy("", ["", "a", "Klärchen"])
+    _assert_matches_strsimpy("Klärchen", ["", "Klärchen", "Klara"])
+
+
+def test_unicode_strings():
+    _assert_matches_strsimpy(
+        "Müller-Lüdenscheidt", ["Mueller-Luedenscheidt", "Müller", "日本 Müller", "ß"]
+    )